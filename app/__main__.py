@@ -1,19 +1,56 @@
+import sys
+
+# `serve --async` runs on gevent, whose patches have to be in place before
+# anything else imports socket, ssl, subprocess or threading
+ASYNC_SERVING = "serve" in sys.argv[1:2] and "--async" in sys.argv[2:]
+if ASYNC_SERVING:
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import argparse
+import contextlib
 import flask
+import hashlib
+import hmac
+import json
+import mimetypes
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pulumi import automation as auto
 import requests
 
+from account_store import AccountStore
+from deployment_status import DeploymentStatusPoller
+from inventory import AccountInventory
+import bulk
+import deployment_settings
+import dispatch
+import drift
+import jobs
+import metrics
+import pulumi_cloud
+import rollout
+import static_assets
+import timeline
+
 # references the templates and static files in the assets dir
 template_dir = os.path.abspath("./assets/templates")
 css_dir = os.path.abspath("./assets/static")
+# fingerprinted, precompressed copies of the static files, served on /assets
+asset_build_dir = os.path.abspath("./assets/dist")
 app = flask.Flask(
     __name__,
     template_folder=template_dir,
-    static_folder=css_dir,
+    static_folder=None,
     instance_relative_config=True,
 )
 app.config.from_object("config")
 app.config.from_pyfile("config.py")
+# FLASK_* environment variables override both, e.g. FLASK_PULUMI_ACCESS_TOKEN
+app.config.from_prefixed_env()
 app.secret_key = "super-secret-key"
 
 # we want all our deployments to go into the same stack
@@ -22,12 +59,185 @@ access_token = app.config["PULUMI_ACCESS_TOKEN"]
 pulumi_org = app.config["PULUMI_ORG"]
 git_org = app.config["GITHUB_ORG"]
 git_repo = app.config["GITHUB_REPO"]
-git_branch = "main"
+git_branch = app.config["GITHUB_BRANCH"]
+aws_region = app.config["DEPLOYMENT_AWS_REGION"]
 aws_controltower_org = app.config["ACCOUNT_OU"]
 aws_controltower_org_id_on_delete = app.config["ACCOUNT_OU_ON_DELETE"]
 oidc_role_arn = app.config["OIDC_ROLE_ARN"]
-# set the access token
-headers = {"Authorization": f"token {access_token}"}
+# served on /metrics in the Prometheus text format
+registry = metrics.Registry()
+phase_seconds = registry.histogram(
+    "vending_phase_seconds",
+    "Time spent in each account provisioning or deletion phase",
+    ["phase", "status"],
+)
+api_requests = registry.counter(
+    "vending_pulumi_api_requests_total",
+    "Pulumi Cloud API requests by endpoint and status code",
+    ["endpoint", "status"],
+)
+api_seconds = registry.histogram(
+    "vending_pulumi_api_request_seconds",
+    "Pulumi Cloud API request latency by endpoint",
+    ["endpoint"],
+)
+http_requests = registry.counter(
+    "vending_http_requests_total",
+    "Requests served by the web app by endpoint and status code",
+    ["endpoint", "status"],
+)
+provisioning_in_flight = registry.gauge(
+    "vending_provisioning_in_flight", "Account provisioning jobs currently running"
+)
+
+
+def record_api_request(endpoint, seconds, status):
+    api_requests.inc(endpoint=endpoint, status=status)
+    api_seconds.observe(seconds, endpoint=endpoint)
+
+
+def record_phase(phase, seconds, status):
+    phase_seconds.observe(seconds, phase=phase, status=status)
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """records a phase that doesn't run inside a job"""
+    started = time.monotonic()
+    status = jobs.FAILED
+    try:
+        yield
+        status = jobs.SUCCEEDED
+    finally:
+        record_phase(phase, time.monotonic() - started, status)
+
+
+# one pooled client, authenticated with our access token, for every Pulumi Cloud call
+cloud = pulumi_cloud.PulumiCloudClient(
+    access_token,
+    api_url=app.config["PULUMI_API_URL"],
+    timeout=(
+        app.config["PULUMI_API_CONNECT_TIMEOUT"],
+        app.config["PULUMI_API_READ_TIMEOUT"],
+    ),
+    max_retries=app.config["PULUMI_API_MAX_RETRIES"],
+    pool_size=app.config["PULUMI_API_POOL_SIZE"],
+    on_request=record_api_request,
+)
+
+
+# new stacks are tagged with their owner's email and OU so the directory can show them
+EMAIL_TAG = "vending:email"
+OU_TAG = "vending:ou"
+
+
+def load_accounts():
+    # the REST API only needs an HTTP round trip per page, no pulumi binary
+    if app.config["STACK_LISTING_BACKEND"] == "api":
+        return [
+            {"name": stack["stackName"]}
+            for stack in cloud.list_stacks(pulumi_org, project_name)
+        ]
+
+    ws = auto.LocalWorkspace(
+        project_settings=auto.ProjectSettings(name=project_name, runtime="python")
+    )
+    return [{"name": stack.name} for stack in ws.list_stacks()]
+
+
+def load_account_details(name):
+    r = cloud.get_stack(pulumi_org, project_name, name)
+    r.raise_for_status()
+    tags = r.json().get("tags") or {}
+    return {"email": tags.get(EMAIL_TAG), "ou": tags.get(OU_TAG)}
+
+
+def load_account_id(name):
+    """reads the AWS account ID from the stack's outputs, None until it is deployed"""
+    r = cloud.export_stack(pulumi_org, project_name, name)
+    r.raise_for_status()
+    for resource in r.json().get("deployment", {}).get("resources") or []:
+        if resource.get("type") == "pulumi:pulumi:Stack":
+            outputs = resource.get("outputs") or {}
+            return outputs.get(app.config["ACCOUNT_ID_OUTPUT"])
+    return None
+
+
+def load_account_records():
+    """every account with its details and account ID, for a full inventory rebuild"""
+
+    def load(account):
+        name = account["name"]
+        try:
+            return {
+                **account,
+                **load_account_details(name),
+                "account_id": load_account_id(name),
+            }
+        except requests.exceptions.RequestException as err:
+            print(f"Error loading details for account '{name}': {err}")
+            return account
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        return list(executor.map(load, load_accounts()))
+
+
+if app.config["ACCOUNT_INVENTORY"] == "sqlite":
+    # kept current by /webhooks/pulumi, rebuilt with `__main__.py rebuild-inventory`
+    inventory = AccountStore(
+        os.path.join(app.instance_path, app.config["ACCOUNTS_DB"]),
+        loader=load_account_records,
+    )
+else:
+    # listing stacks can shell out to the pulumi CLI, so the index renders from a cache
+    inventory = AccountInventory(
+        load_accounts,
+        ttl=app.config["INVENTORY_TTL_SECONDS"],
+        details_loader=load_account_details,
+    )
+
+
+def fetch_deployment_status(stack_name, deployment_id):
+    r = cloud.get_deployment(pulumi_org, project_name, stack_name, deployment_id)
+    r.raise_for_status()
+    return r.json()["status"]
+
+
+# follows dispatched deployments and feeds the index page's event stream
+# every provisioning stage, from request to finished deployment, for `latency-report`
+timelines = timeline.Timeline(
+    os.path.join(app.instance_path, app.config["TIMELINE_FILE"])
+)
+
+
+def record_deployment_finished(status):
+    timelines.record(
+        status.get("correlation_id"),
+        timeline.DEPLOYMENT_FINISHED,
+        stack=status["stack"],
+        status=status["status"],
+    )
+
+
+deployment_statuses = DeploymentStatusPoller(
+    fetch_deployment_status,
+    interval=app.config["DEPLOYMENT_STATUS_INTERVAL_SECONDS"],
+    batch_size=app.config["DEPLOYMENT_STATUS_BATCH_SIZE"],
+    on_finished=record_deployment_finished,
+)
+
+
+# every deployment goes out through this, paced to what Pulumi Deployments accepts
+deployment_dispatcher = dispatch.DeploymentScheduler(
+    cloud.create_deployment,
+    lambda org, project, stack, deployment_id: fetch_deployment_status(
+        stack, deployment_id
+    ),
+    rate=app.config["DEPLOYMENT_RATE_PER_SECOND"],
+    burst=app.config["DEPLOYMENT_BURST"],
+    max_running=app.config["DEPLOYMENT_MAX_RUNNING"],
+    poll_interval=app.config["DEPLOYMENT_RUNNING_POLL_SECONDS"],
+)
 
 
 # We're not building the program locally, so we can just return a no-op program.
@@ -35,166 +245,778 @@ def create_pulumi_program():
     return
 
 
+@app.template_global()
+def stack_url(name):
+    return f"https://app.pulumi.com/{pulumi_org}/{project_name}/{name}"
+
+
+@app.template_global()
+def status_class(status):
+    """picks the badge colour for a deployment status"""
+    if not status:
+        return ""
+    return {
+        "succeeded": "bg-success",
+        "failed": "bg-danger",
+        "skipped": "bg-secondary",
+        "unknown": "bg-secondary",
+    }.get(status["status"], "bg-info")
+
+
 @app.route("/ping", methods=["GET"])
 def ping():
     return flask.jsonify("pong!", 200)
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return flask.Response(
+        registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+asset_manifest = static_assets.load_manifest(css_dir, asset_build_dir)
+published_assets = frozenset(asset_manifest.values())
+
+
+@app.template_global()
+def asset_url(name):
+    return flask.url_for("asset", filename=asset_manifest[name])
+
+
+@app.route("/assets/<path:filename>", methods=["GET"])
+def asset(filename):
+    """serves a fingerprinted asset, in the smallest encoding the client takes"""
+    if filename not in published_assets:
+        flask.abort(404)
+    variant, encoding = static_assets.pick_variant(
+        asset_build_dir, filename, flask.request.headers.get("Accept-Encoding")
+    )
+    response = flask.send_from_directory(
+        asset_build_dir,
+        variant,
+        mimetype=mimetypes.guess_type(filename)[0],
+        conditional=True,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    # the name changes with the content, so this URL never needs revalidating
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@app.after_request
+def make_pages_conditional(response):
+    """lets browsers revalidate rendered pages with If-None-Match and get a 304"""
+    if (
+        flask.request.method == "GET"
+        and response.status_code == 200
+        and response.mimetype == "text/html"
+        and not response.is_streamed
+    ):
+        response.add_etag()
+        response.headers.setdefault("Cache-Control", "no-cache")
+        response.make_conditional(flask.request)
+    return response
+
+
+@app.after_request
+def count_request(response):
+    http_requests.inc(
+        endpoint=flask.request.endpoint or "unknown", status=response.status_code
+    )
+    return response
+
+
 @app.route("/", methods=["GET"])
 def list_accounts():
-    deployments = []
+    query = flask.request.args.get("q", "").strip()
+    page = max(1, flask.request.args.get("page", 1, type=int))
+    per_page = flask.request.args.get(
+        "per_page", app.config["ACCOUNTS_PER_PAGE"], type=int
+    )
+    per_page = min(max(1, per_page), app.config["ACCOUNTS_MAX_PER_PAGE"])
+    descending = flask.request.args.get("sort") == "-name"
+
+    deployments, total = [], 0
     try:
-        ws = auto.LocalWorkspace(
-            project_settings=auto.ProjectSettings(name=project_name, runtime="python")
-        )
-        all_stacks = ws.list_stacks()
-        for stack in all_stacks:
-            stack = auto.select_stack(
-                stack_name=stack.name,
-                project_name=project_name,
-                # no-op program, just to get outputs
-                program=lambda: None,
-            )
-            deployments.append({"name": stack.name})
+        deployments, total = inventory.page(query, page, per_page, descending)
     except Exception as exn:
         flask.flash(str(exn), category="danger")
-    return flask.render_template("index.html", deployments=deployments)
+    return flask.render_template(
+        "index.html",
+        deployments=deployments,
+        statuses=deployment_statuses.statuses(),
+        drift=drift_summary.load(),
+        query=query,
+        page=page,
+        per_page=per_page,
+        sort="-name" if descending else "name",
+        total=total,
+        pages=max(1, -(-total // per_page)),
+    )
 
 
-@app.route("/new", methods=["GET", "POST"])
-def create_account():
-    """creates new deployment"""
-    if flask.request.method == "POST":
-        name = flask.request.form.get("accountname")
-        email = flask.request.form.get("email")
-        first_name = flask.request.form.get("firstname")
-        last_name = flask.request.form.get("lastname")
+@app.route("/events", methods=["GET"])
+def deployment_events():
+    """streams deployment status changes as server-sent events"""
+    return flask.Response(
+        deployment_statuses.stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        def pulumi_program():
-            return create_pulumi_program()
 
+def create_stack(job, name, email, correlation_id=None):
+    """
+    Registers the account's stack. The remote deployment populates it and sets
+    its config, so in "api" mode this is a single REST call; the Automation API
+    path is kept for "cli" mode and as a fallback when the API call fails.
+    """
+    tags = {
+        EMAIL_TAG: email,
+        OU_TAG: aws_controltower_org,
+        timeline.CORRELATION_TAG: correlation_id,
+    }
+    # the CLI refuses empty tag values
+    tags = {key: value for key, value in tags.items() if value}
+    if app.config["PROVISIONING_MODE"] == "api":
         try:
-            # create a new stack, generating our pulumi program on the fly from the POST body
-            stack = auto.create_stack(
-                stack_name=f"{pulumi_org}/{project_name}/{name}",
-                project_name=project_name,
-                program=pulumi_program,
-            )
-            stack.set_config("name", auto.ConfigValue(value=name))
-            stack.set_config("email", auto.ConfigValue(value=email))
-
-            stack.refresh()
-
-            # create the deployment settings
-            try:
-                r = requests.post(
-                    f"https://api.pulumi.com/api/stacks/{pulumi_org}/{project_name}/{name}/deployments/settings",
-                    json={
-                        "sourceContext": {
-                            "git": {"branch": f"refs/heads/{git_branch}"}
-                        },
-                        "gitHub": {
-                            "repository": f"{git_org}/{git_repo}",
-                            "deployCommits": True,
-                            "previewPullRequests": True,
-                        },
-                        "operationContext": {
-                            "preRunCommands": [
-                                f"pulumi config set name {name} -s {pulumi_org}/{name}",
-                                f"pulumi config set email {email} -s {pulumi_org}/{name}",
-                                f"pulumi config set organizationalUnit {aws_controltower_org} -s {pulumi_org}/{name}",
-                                f"pulumi config set organizationalUnitIdOnDelete {aws_controltower_org_id_on_delete} -s {pulumi_org}/{name}",
-                                f"pulumi config set ssoEmail {email} -s {pulumi_org}/{name}",
-                                f"pulumi config set ssoFirstName {first_name} -s {pulumi_org}/{name}",
-                                f"pulumi config set ssoLastName {last_name} -s {pulumi_org}/{name}",
-                            ],
-                            "oidc": {
-                                "aws": {
-                                    "roleArn": oidc_role_arn,
-                                    "sessionName": "deployment",
-                                }
-                            },
-                            "environmentVariables": {"AWS_REGION": "us-west-2"},
-                        },
-                    },
-                    headers=headers,
-                )
-
-                response = r.json()
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as err:
-                flask.flash(
-                    f"Error creating deployment settings: {err} - response: {response}",
-                    category="danger",
-                )
-
-            try:
-                # create the deployment
-                r = requests.post(
-                    f"https://api.pulumi.com/api/stacks/{pulumi_org}/{project_name}/{name}/deployments",
-                    json={
-                        "operation": "update",
-                    },
-                    headers=headers,
-                )
-                response = r.json()
-                r.raise_for_status()
-                
-            except requests.exceptions.HTTPError as err:
-                flask.flash(
-                    f"Error creating deployment: {err} - response: {response}",
-                    category="danger",
-                )
+            with job.phase("create_stack"):
+                cloud.create_stack(pulumi_org, project_name, name, tags=tags)
+            return
+        except requests.exceptions.RequestException as err:
+            print(f"Error creating stack '{name}' through the API: {err}")
+            print("Falling back to the automation API")
 
-            flask.flash(
-                f"Successfully dispatched account deployment '{name}': response {response}",
-                category="success",
+    def pulumi_program():
+        return create_pulumi_program()
+
+    with job.phase("create_stack"):
+        # create a new stack, generating our pulumi program on the fly from the POST body
+        stack = auto.create_stack(
+            stack_name=f"{pulumi_org}/{project_name}/{name}",
+            project_name=project_name,
+            program=pulumi_program,
+        )
+
+    with job.phase("set_config"):
+        stack.set_config("name", auto.ConfigValue(value=name))
+        stack.set_config("email", auto.ConfigValue(value=email))
+        for key, value in tags.items():
+            stack.workspace.set_tag(stack.name, key, value)
+
+    with job.phase("refresh"):
+        stack.refresh()
+
+
+def provision_account(job):
+    """creates the account stack and dispatches its first deployment, phase by phase"""
+    name = job.params["accountname"]
+    email = job.params["email"]
+    first_name = job.params["firstname"]
+    last_name = job.params["lastname"]
+    correlation_id = job.params.get("correlation_id")
+    timelines.record(correlation_id, timeline.STARTED, stack=name)
+
+    try:
+        create_stack(job, name, email, correlation_id)
+    except (auto.StackAlreadyExistsError, pulumi_cloud.StackAlreadyExistsError):
+        inventory.add(name)
+        raise Exception(
+            f"Deployment with name '{name}' already exists, pick a unique name"
+        )
+    inventory.add(name, email=email, ou=aws_controltower_org)
+    timelines.record(correlation_id, timeline.STACK_CREATED, stack=name)
+
+    # create the deployment settings
+    with job.phase("deployment_settings"):
+        r = cloud.update_deployment_settings(
+            pulumi_org,
+            project_name,
+            name,
+            deployment_settings.deployment_settings(
+                pulumi_org=pulumi_org,
+                name=name,
+                email=email,
+                first_name=first_name,
+                last_name=last_name,
+                ou=aws_controltower_org,
+                ou_id_on_delete=aws_controltower_org_id_on_delete,
+                git_org=git_org,
+                git_repo=git_repo,
+                git_branch=git_branch,
+                oidc_role_arn=oidc_role_arn,
+                aws_region=aws_region,
+                correlation_id=correlation_id,
+            ),
+        )
+        raise_for_response(r, "Error creating deployment settings")
+    timelines.record(correlation_id, timeline.SETTINGS_WRITTEN, stack=name)
+
+    # create the deployment
+    with job.phase("deployment"):
+        try:
+            r = deployment_dispatcher.dispatch(
+                pulumi_org,
+                project_name,
+                name,
+                "update",
+                timeout=app.config["DEPLOYMENT_DISPATCH_TIMEOUT_SECONDS"],
+            )
+        except dispatch.DispatchTimeout as err:
+            raise Exception(
+                f"Stack '{name}' was created but its deployment wasn't dispatched: "
+                f"{err}"
             )
-        except auto.StackAlreadyExistsError:
+        raise_for_response(r, "Error creating deployment")
+
+    deployment_id = r.json()["id"]
+    timelines.record(
+        correlation_id,
+        timeline.DEPLOYMENT_DISPATCHED,
+        stack=name,
+        deployment_id=deployment_id,
+    )
+    deployment_statuses.track(
+        name, deployment_id, "update", correlation_id=correlation_id
+    )
+    return r.json()
+
+
+def raise_for_response(r, message):
+    try:
+        r.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        raise Exception(f"{message}: {err} - response: {r.text}")
+
+
+def track_provisioning(job):
+    with provisioning_in_flight.track():
+        return provision_account(job)
+
+
+# provisioning runs on this worker pool instead of the request thread
+job_queue = jobs.JobQueue(
+    jobs.JobStore(os.path.join(app.instance_path, app.config["JOBS_DB"])),
+    {"provision_account": track_provisioning},
+    workers=app.config["PROVISIONING_WORKERS"],
+    on_phase=record_phase,
+)
+
+
+@app.route("/new", methods=["GET", "POST"])
+def create_account():
+    """queues a new deployment"""
+    if flask.request.method == "POST":
+        params = {
+            field: flask.request.form.get(field)
+            for field in ("accountname", "email", "firstname", "lastname")
+        }
+        name = params["accountname"]
+
+        # cheap check against the cached inventory before paying for the CLI
+        if inventory.exists(name):
             flask.flash(
                 f"Error: Deployment with name '{name}' already exists, pick a unique name",
                 category="danger",
             )
+            return flask.redirect(flask.url_for("list_accounts"))
+
+        params["correlation_id"] = timeline.new_correlation_id()
+        timelines.record(params["correlation_id"], timeline.RECEIVED, stack=name)
+        job_id = job_queue.submit("provision_account", params)
+        if flask.request.accept_mimetypes.best == "application/json":
+            return (
+                flask.jsonify(
+                    {"id": job_id, "url": flask.url_for("get_job", job_id=job_id)}
+                ),
+                202,
+            )
 
+        flask.flash(
+            f"Queued account deployment '{name}', track it at "
+            f"{flask.url_for('get_job', job_id=job_id)}",
+            category="success",
+        )
         return flask.redirect(flask.url_for("list_accounts"))
 
     return flask.render_template("create.html")
 
 
+def provision_manifest_row(row):
+    row = dict(row, correlation_id=timeline.new_correlation_id())
+    timelines.record(row["correlation_id"], timeline.RECEIVED, stack=row["accountname"])
+    job = job_queue.run("provision_account", row)
+    return {"status": job["status"], "job": job["id"], "error": job["error"]}
+
+
+@app.route("/bulk", methods=["POST"])
+def bulk_create_accounts():
+    """
+    Provisions every account in an uploaded CSV/JSON manifest, streaming one
+    JSON line per row as it finishes.
+    """
+    upload = flask.request.files.get("manifest")
+    if upload is not None:
+        data, filename = upload.read().decode("utf-8"), upload.filename or ""
+    else:
+        data, filename = flask.request.get_data(as_text=True), ""
+        if flask.request.mimetype == "application/json":
+            filename = "manifest.json"
+
+    try:
+        rows = bulk.parse_manifest(data, filename)
+    except bulk.ManifestError as err:
+        return flask.jsonify({"error": str(err)}), 400
+
+    concurrency = flask.request.args.get(
+        "concurrency", app.config["BULK_CONCURRENCY"], type=int
+    )
+    concurrency = min(concurrency, app.config["BULK_MAX_CONCURRENCY"])
+    results = bulk.provision_all(
+        rows, provision_manifest_row, concurrency=concurrency, exists=inventory.exists
+    )
+    return flask.Response(
+        (json.dumps(result) + "\n" for result in results),
+        mimetype="application/x-ndjson",
+    )
+
+
+def bulk_create_accounts_command(manifest, concurrency):
+    with open(manifest) as f:
+        rows = bulk.parse_manifest(f.read(), manifest)
+
+    failed = 0
+    for result in bulk.provision_all(
+        rows, provision_manifest_row, concurrency=concurrency, exists=inventory.exists
+    ):
+        failed += result["status"] != jobs.SUCCEEDED
+        print(json.dumps(result), flush=True)
+    print(f"{len(rows) - failed}/{len(rows)} accounts provisioned")
+    return failed == 0
+
+
+def current_deployment_settings(name):
+    r = cloud.get_deployment_settings(pulumi_org, project_name, name)
+    if r.status_code == 404:
+        return {}
+    raise_for_response(r, "Error fetching deployment settings")
+    return r.json()
+
+
+def desired_deployment_settings(name, current):
+    """the template's settings for a stack, keeping the user it was created for"""
+    commands = (current.get("operationContext") or {}).get("preRunCommands")
+    config = deployment_settings.parse_config_commands(commands)
+    if not config.get("email"):
+        return None
+    return deployment_settings.deployment_settings(
+        pulumi_org=pulumi_org,
+        name=name,
+        email=config["email"],
+        first_name=config.get("ssoFirstName", ""),
+        last_name=config.get("ssoLastName", ""),
+        ou=aws_controltower_org,
+        ou_id_on_delete=aws_controltower_org_id_on_delete,
+        git_org=git_org,
+        git_repo=git_repo,
+        git_branch=git_branch,
+        oidc_role_arn=oidc_role_arn,
+        aws_region=aws_region,
+    )
+
+
+def apply_deployment_settings(name, settings):
+    r = cloud.update_deployment_settings(pulumi_org, project_name, name, settings)
+    raise_for_response(r, "Error updating deployment settings")
+
+
+def rollout_settings_command(concurrency, dry_run, restart):
+    # everything the template takes from config, a change starts a new rollout
+    inputs = [
+        aws_controltower_org,
+        aws_controltower_org_id_on_delete,
+        git_org,
+        git_repo,
+        git_branch,
+        oidc_role_arn,
+        aws_region,
+    ]
+    fingerprint = hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:16]
+    path = os.path.join(app.instance_path, app.config["ROLLOUT_CHECKPOINT"])
+    if restart and os.path.exists(path):
+        os.remove(path)
+    checkpoint = None if dry_run else rollout.Checkpoint(path, fingerprint)
+
+    counts = {}
+    for result in rollout.rollout(
+        [account["name"] for account in load_accounts()],
+        current_deployment_settings,
+        desired_deployment_settings,
+        apply_deployment_settings,
+        concurrency=concurrency,
+        checkpoint=checkpoint,
+        dry_run=dry_run,
+    ):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        print(json.dumps(result), flush=True)
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return rollout.FAILED not in counts
+
+
+def fetch_deployment_finished(stack, deployment_id):
+    """when a deployment finished, for timelines that weren't seen to finish"""
+    r = cloud.get_deployment(pulumi_org, project_name, stack, deployment_id)
+    if not r.ok:
+        return None
+    deployment = r.json()
+    if deployment.get("status") not in ("succeeded", "failed", "skipped"):
+        return None
+    finished = deployment.get("modified") or deployment.get("updated")
+    return timeline.parse_time(finished) if finished else None
+
+
+def latency_report_command(paths, slo_seconds):
+    lines = []
+    for path in paths:
+        with open(path) as f:
+            lines.extend(f)
+    result = timeline.report(
+        timeline.load(lines), slo_seconds, fetch_finished=fetch_deployment_finished
+    )
+    print(json.dumps(result, indent=2))
+    return not result["breaches"]
+
+
+# the last `drift-scan`'s results, shown on the index page
+drift_summary = drift.Summary(
+    os.path.join(app.instance_path, app.config["DRIFT_SUMMARY"])
+)
+
+
+def dispatch_drift_check(name):
+    r = deployment_dispatcher.dispatch(
+        pulumi_org,
+        project_name,
+        name,
+        app.config["DRIFT_OPERATION"],
+        timeout=app.config["DEPLOYMENT_DISPATCH_TIMEOUT_SECONDS"],
+    )
+    raise_for_response(r, "Error dispatching drift check")
+    return r.json()["id"]
+
+
+def fetch_drift_check(name, deployment_id):
+    r = cloud.get_deployment(pulumi_org, project_name, name, deployment_id)
+    raise_for_response(r, "Error fetching drift check")
+    return r.json()
+
+
+def drift_changes(name, deployment):
+    """adds up the resource changes of the updates a drift check ran"""
+    changes = {}
+    for update in deployment.get("updates") or []:
+        counts = update.get("resourceChanges")
+        if counts is None:
+            r = cloud.get_update(pulumi_org, project_name, name, update["version"])
+            raise_for_response(r, "Error fetching drift check update")
+            counts = (r.json().get("info") or {}).get("resourceChanges") or {}
+        for op, count in counts.items():
+            changes[op] = changes.get(op, 0) + count
+    return changes
+
+
+def drift_scan_command(concurrency, every=None):
+    while True:
+        counts = {}
+        try:
+            for result in drift.scan_into(
+                drift_summary,
+                [account["name"] for account in load_accounts()],
+                dispatch=dispatch_drift_check,
+                fetch_deployment=fetch_drift_check,
+                fetch_changes=drift_changes,
+                concurrency=concurrency,
+                poll_interval=app.config["DEPLOYMENT_STATUS_INTERVAL_SECONDS"],
+                timeout=app.config["DRIFT_TIMEOUT_SECONDS"],
+            ):
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+                print(json.dumps(result), flush=True)
+        except requests.exceptions.RequestException as err:
+            # a scheduled scan tries again next time
+            if not every:
+                raise
+            print(f"Error listing accounts for the drift scan: {err}", flush=True)
+        print(", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+        if not every:
+            return drift.DRIFTED not in counts and drift.FAILED not in counts
+        time.sleep(every)
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+def get_job(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return flask.jsonify({"error": f"job '{job_id}' not found"}), 404
+    return flask.jsonify(job)
+
+
+# fetches account IDs after deployments finish, off the webhook's request
+account_id_loader = ThreadPoolExecutor(max_workers=2)
+
+
+def refresh_account_id(name):
+    try:
+        account_id = load_account_id(name)
+    except requests.exceptions.RequestException as err:
+        app.logger.warning("Error loading the account ID of '%s': %s", name, err)
+        return
+    if account_id:
+        inventory.add(name, account_id=account_id)
+
+
+@app.route("/webhooks/pulumi", methods=["POST"])
+def pulumi_webhook():
+    """
+    Applies a Pulumi Cloud stack, update or deployment webhook to the account
+    inventory.
+    """
+    secret = app.config["PULUMI_WEBHOOK_SECRET"]
+    # without a secret nothing can be verified, so the endpoint is off
+    if not secret:
+        flask.abort(404)
+    expected = hmac.new(
+        secret.encode(), flask.request.get_data(), hashlib.sha256
+    ).hexdigest()
+    signature = flask.request.headers.get("Pulumi-Webhook-Signature", "")
+    if not hmac.compare_digest(expected, signature):
+        flask.abort(401)
+
+    kind = flask.request.headers.get("Pulumi-Webhook-Kind")
+    event = flask.request.get_json(silent=True) or {}
+    if event.get("projectName") != project_name or not event.get("stackName"):
+        return "", 204
+    name = event["stackName"]
+
+    if kind == "stack":
+        if event.get("action") == "deleted":
+            inventory.remove(name)
+        elif event.get("action") == "created":
+            inventory.add(name)
+    elif kind in ("update", "deployment"):
+        # update events carry the operation as "kind", deployments as "operation"
+        operation = event.get("operation") or event.get("kind")
+        status = event.get("status") or event.get("result")
+        inventory.add(
+            name,
+            last_operation=operation,
+            last_status=status,
+            last_deployment_url=event.get("deploymentUrl") or event.get("updateUrl"),
+        )
+        if operation == "update" and status == "succeeded":
+            account_id_loader.submit(refresh_account_id, name)
+    return "", 204
+
+
+def track_queued_deployment(name, operation, future):
+    """follows a deployment the request that queued it didn't wait for"""
+    try:
+        r = future.result()
+        r.raise_for_status()
+    except Exception as err:
+        app.logger.warning("Error dispatching %s of '%s': %s", operation, name, err)
+        return
+    deployment_statuses.track(name, r.json()["id"], operation)
+
+
 @app.route("/<string:id>/delete", methods=["POST"])
 def delete_account(id: str):
     account_name = id
-    print(account_name)
+    app.logger.info("Deleting account '%s'", account_name)
     try:
-        stack = auto.select_stack(
-            stack_name=account_name,
-            project_name=project_name,
-            # noop program for destroy
-            program=lambda: None,
-        )
+        with timed_phase("select_stack"):
+            stack = auto.select_stack(
+                stack_name=account_name,
+                project_name=project_name,
+                # noop program for destroy
+                program=lambda: None,
+            )
 
+        future = deployment_dispatcher.submit(
+            pulumi_org, project_name, account_name, "delete"
+        )
         try:
-            r = requests.post(
-                f"https://api.pulumi.com/api/stacks/{pulumi_org}/{project_name}/{account_name}/deployments",
-                json={
-                    "operation": "delete",
-                },
-                headers=headers,
+            # the org can be at its running-deployment cap for many minutes, so
+            # the request only waits briefly and the delete stays queued
+            with timed_phase("delete_deployment"):
+                r = future.result(app.config["DEPLOYMENT_DISPATCH_WAIT_SECONDS"])
+            r.raise_for_status()
+        except FutureTimeoutError:
+            future.add_done_callback(
+                lambda done: track_queued_deployment(account_name, "delete", done)
             )
-        except requests.exceptions.HTTPError as err:
+            flask.flash(
+                f"'{account_name}' deletion is queued until there is room for "
+                "another deployment",
+                category="info",
+            )
+        except requests.exceptions.RequestException as err:
+            app.logger.warning("Error deleting account '%s': %s", account_name, err)
             flask.flash(
                 f"Error dispatching account deletion deployment: {err}",
                 category="danger",
             )
-
-        flask.flash(
-            f"Successfully dispatched '{account_name}' deletion!", category="success"
-        )
+        else:
+            deployment_statuses.track(account_name, r.json()["id"], "delete")
+            flask.flash(
+                f"Successfully dispatched '{account_name}' deletion!",
+                category="success",
+            )
+        # the stack lingers until the delete deployment finishes, so re-list it
+        inventory.invalidate()
     except Exception as exn:
         flask.flash(str(exn), category="danger")
 
     return flask.redirect(flask.url_for("list_accounts"))
 
 
+def serve_async(host="localhost", port=5050):
+    """
+    Serves the app from one process on gevent. The standard library is
+    patched at startup, so the Pulumi Cloud client's sockets, the Automation
+    API's pulumi subprocesses and the worker threads all yield to each other
+    instead of holding an OS thread each while they wait.
+    """
+    import grpc.experimental.gevent
+    from gevent.pywsgi import WSGIServer
+
+    # the Automation API talks gRPC to the pulumi CLI
+    grpc.experimental.gevent.init_gevent()
+    app.logger.info("Serving on http://%s:%s with gevent", host, port)
+    WSGIServer((host, port), app).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Account vending machine web app and commands."
+    )
+
+    subparsers = parser.add_subparsers(title="commands", dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="run the web app (the default)")
+    serve_parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Serve on gevent: every request is a greenlet, I/O doesn't block",
+    )
+
+    bulk_parser = subparsers.add_parser(
+        "bulk", help="provision every account in a CSV/JSON manifest"
+    )
+    bulk_parser.add_argument("manifest", help="Path to the manifest file")
+    bulk_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=app.config["BULK_CONCURRENCY"],
+        help="How many accounts to provision at once",
+    )
+
+    subparsers.add_parser(
+        "rebuild-inventory",
+        help="reload the persistent account inventory from Pulumi Cloud",
+    )
+
+    rollout_parser = subparsers.add_parser(
+        "rollout-settings",
+        help="update the deployment settings of every stack that drifted",
+    )
+    rollout_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=app.config["ROLLOUT_CONCURRENCY"],
+        help="How many stacks to check and update at once",
+    )
+    rollout_parser.add_argument(
+        "--dry-run", action="store_true", help="Only report the stacks that drifted"
+    )
+    rollout_parser.add_argument(
+        "--restart", action="store_true", help="Ignore the checkpoint of an earlier run"
+    )
+
+    report_parser = subparsers.add_parser(
+        "latency-report",
+        help="per-stage provisioning latency and SLO breaches",
+    )
+    report_parser.add_argument(
+        "timelines",
+        nargs="*",
+        help="Timeline files or exported lambda logs (default: the app's own)",
+    )
+    report_parser.add_argument(
+        "--slo",
+        type=float,
+        default=app.config["PROVISIONING_SLO_SECONDS"],
+        help="Seconds from request to finished deployment",
+    )
+
+    drift_parser = subparsers.add_parser(
+        "drift-scan", help="check every stack for drift with parallel deployments"
+    )
+    drift_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=app.config["DRIFT_CONCURRENCY"],
+        help="How many drift checks to run at once",
+    )
+    drift_parser.add_argument(
+        "--every",
+        type=float,
+        help="Keep running, starting a new scan this many seconds after the last",
+    )
+
+    subparsers.add_parser(
+        "build-assets", help="fingerprint and precompress the static assets"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "build-assets":
+        manifest = static_assets.build(css_dir, asset_build_dir)
+        print(json.dumps(manifest, indent=2))
+        parser.exit(0)
+    elif args.command == "drift-scan":
+        ok = drift_scan_command(args.concurrency, args.every)
+        parser.exit(0 if ok else 1)
+    elif args.command == "latency-report":
+        paths = args.timelines or [timelines.path]
+        parser.exit(0 if latency_report_command(paths, args.slo) else 1)
+    elif args.command == "rollout-settings":
+        ok = rollout_settings_command(args.concurrency, args.dry_run, args.restart)
+        parser.exit(0 if ok else 1)
+    elif args.command == "rebuild-inventory":
+        if not isinstance(inventory, AccountStore):
+            parser.exit(2, "Error: ACCOUNT_INVENTORY is not \"sqlite\"\n")
+        print(f"Rebuilt the inventory with {inventory.rebuild()} accounts")
+        parser.exit(0)
+    elif args.command == "bulk":
+        try:
+            ok = bulk_create_accounts_command(args.manifest, args.concurrency)
+        except bulk.ManifestError as err:
+            parser.exit(2, f"Error: {err}\n")
+        parser.exit(0 if ok else 1)
+    elif args.command == "serve" and args.use_async:
+        job_queue.resume()
+        serve_async()
+    else:
+        # only the process that serves picks up jobs a restart left behind, not
+        # the commands above or the reloader's watching parent
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            job_queue.resume()
+        app.run(host="localhost", port=5050, debug=True)
+
+
 if __name__ == "__main__":
-    app.run(host="localhost", port=5050, debug=True)
+    main()
@@ -0,0 +1,148 @@
+"""
+A persistent account inventory.
+
+The in-memory AccountInventory only knows what listing the stacks tells it,
+which is little more than their names. This keeps one row per account in a
+local SQLite file instead, with the account ID, email, OU and the result of
+its last deployment. Pulumi Cloud webhooks keep the rows up to date as stacks
+are created, deployed and deleted, and `rebuild` repopulates the whole table
+from the API when webhooks were missed. The directory is then served from
+indexed queries without calling Pulumi at request time.
+
+It has the same interface as AccountInventory, so the app can use either.
+"""
+
+import sqlite3
+import threading
+import time
+
+# the columns besides name that callers may set
+FIELDS = (
+    "email",
+    "ou",
+    "account_id",
+    "last_operation",
+    "last_status",
+    "last_deployment_url",
+)
+
+
+def _like_prefix(prefix: str):
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+class AccountStore:
+    def __init__(self, path: str, loader=None):
+        # loader returns every account as a dict with at least a "name" key,
+        # for rebuilding the table from scratch
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS accounts (
+                    name TEXT PRIMARY KEY COLLATE NOCASE,
+                    email TEXT COLLATE NOCASE,
+                    ou TEXT,
+                    account_id TEXT,
+                    last_operation TEXT,
+                    last_status TEXT,
+                    last_deployment_url TEXT,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS accounts_email ON accounts (email)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS accounts_ou ON accounts (ou)")
+
+    def list(self):
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM accounts ORDER BY name").fetchall()
+        return [dict(row) for row in rows]
+
+    def page(self, query="", page=1, per_page=50, descending=False, ou=None):
+        """
+        Returns one page of accounts whose name or email starts with `query`
+        (and that are in `ou`, if given), sorted by name, along with the total
+        number of matches.
+        """
+        where, params = [], []
+        if query:
+            # both columns are NOCASE, so these prefix matches use the indexes
+            where.append("(name LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\')")
+            params += [_like_prefix(query)] * 2
+        if ou:
+            where.append("ou = ?")
+            params.append(ou)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        order = "DESC" if descending else "ASC"
+
+        with self._lock:
+            total = self._db.execute(
+                f"SELECT COUNT(*) FROM accounts {clause}", params
+            ).fetchone()[0]
+            rows = self._db.execute(
+                f"SELECT * FROM accounts {clause} ORDER BY name {order} "
+                "LIMIT ? OFFSET ?",
+                params + [per_page, (page - 1) * per_page],
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def get(self, name):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM accounts WHERE name = ?", (name,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def add(self, name, **fields):
+        """inserts the account, or updates the given fields of an existing one"""
+        fields = {k: v for k, v in fields.items() if k in FIELDS}
+        columns = ["name", *fields, "updated_at"]
+        values = [name, *fields.values(), time.time()]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT INTO accounts ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)}) "
+                f"ON CONFLICT (name) DO UPDATE SET {updates}",
+                values,
+            )
+
+    def remove(self, name):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM accounts WHERE name = ?", (name,))
+
+    def rebuild(self, accounts=None):
+        """replaces every row with `accounts`, or with what the loader returns"""
+        if accounts is None:
+            accounts = self._loader()
+        now = time.time()
+        rows = [
+            (account["name"], *(account.get(f) for f in FIELDS), now)
+            for account in accounts
+        ]
+        marks = ", ".join("?" for _ in range(len(FIELDS) + 2))
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM accounts")
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO accounts (name, {', '.join(FIELDS)}, "
+                f"updated_at) VALUES ({marks})",
+                rows,
+            )
+        return len(rows)
+
+    def refresh(self):
+        self.rebuild()
+
+    def invalidate(self):
+        # webhooks keep the table current, there is nothing to expire
+        pass
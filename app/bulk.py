@@ -0,0 +1,94 @@
+"""
+Bulk account provisioning from a manifest of accounts.
+
+A manifest is either a CSV file with a header row or a JSON list of objects,
+each with the same fields as the `/new` form.
+"""
+
+import csv
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+FIELDS = ("accountname", "email", "firstname", "lastname")
+
+
+class ManifestError(Exception):
+    pass
+
+
+def parse_manifest(data: str, filename: str = ""):
+    """returns the manifest rows, working out the format from the name or content"""
+    data = data.strip()
+    if filename.endswith(".json") or data.startswith("["):
+        try:
+            rows = json.loads(data)
+        except ValueError as err:
+            raise ManifestError(f"invalid JSON manifest: {err}")
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ManifestError("a JSON manifest must be a list of objects")
+    else:
+        reader = csv.DictReader(io.StringIO(data))
+        missing = set(FIELDS) - set(reader.fieldnames or [])
+        if missing:
+            raise ManifestError(
+                f"CSV manifest is missing columns: {', '.join(sorted(missing))}"
+            )
+        rows = list(reader)
+
+    return [
+        {field: str(row.get(field) or "").strip() for field in FIELDS} for row in rows
+    ]
+
+
+def validate(rows, exists=lambda name: False):
+    """
+    Splits rows into ones worth provisioning and error results for the rest,
+    so bad rows fail fast without costing a stack creation.
+    """
+    valid, errors, seen = [], [], set()
+    for index, row in enumerate(rows):
+        name = row["accountname"]
+        missing = [field for field in FIELDS if not row[field]]
+        if missing:
+            error = f"missing {', '.join(missing)}"
+        elif name in seen:
+            error = f"duplicate account name '{name}' in manifest"
+        elif exists(name):
+            error = f"Deployment with name '{name}' already exists"
+        else:
+            error = None
+
+        seen.add(name)
+        if error:
+            errors.append(
+                {"row": index, "name": name, "status": "failed", "error": error}
+            )
+        else:
+            valid.append((index, row))
+    return valid, errors
+
+
+def provision_all(rows, provision, concurrency: int = 5, exists=lambda name: False):
+    """
+    Provisions manifest rows with at most `concurrency` in flight, yielding a
+    result per row as soon as it finishes. `provision` takes a row and returns a
+    dict that is merged into the row's result.
+    """
+    valid, errors = validate(rows, exists)
+    yield from errors
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="bulk"
+    ) as executor:
+        futures = {
+            executor.submit(provision, row): (index, row) for index, row in valid
+        }
+        for future in as_completed(futures):
+            index, row = futures[future]
+            result = {"row": index, "name": row["accountname"]}
+            try:
+                result.update(future.result())
+            except Exception as exn:
+                result.update({"status": "failed", "error": str(exn)})
+            yield result
@@ -4,4 +4,61 @@ PULUMI_ORG = "lbrlabs"
 PULUMI_PROJECT_NAME = "aws-accounts"
 GITHUB_ORG = "lbrlabs"
 GITHUB_REPO = "aws-accounts"
-OIDC_ROLE_ARN = "arn:aws:iam::609316800003:role/pulumi-deploy-ff54f5f"
\ No newline at end of file
+GITHUB_BRANCH = "main"
+# the AWS region deployments run their AWS provider in
+DEPLOYMENT_AWS_REGION = "us-west-2"
+OIDC_ROLE_ARN = "arn:aws:iam::609316800003:role/pulumi-deploy-ff54f5f"
+INVENTORY_TTL_SECONDS = 60
+# "api" lists stacks through the Pulumi Cloud REST API, "cli" through the Automation API
+STACK_LISTING_BACKEND = "api"
+# Pulumi Cloud API client settings, timeouts are in seconds
+PULUMI_API_URL = "https://api.pulumi.com"
+PULUMI_API_CONNECT_TIMEOUT = 3.05
+PULUMI_API_READ_TIMEOUT = 20
+PULUMI_API_MAX_RETRIES = 3
+# keep-alive connections shared by every request, raise it for `serve --async`
+PULUMI_API_POOL_SIZE = 10
+# provisioning jobs run on a background worker pool, tracked in a SQLite file in the instance dir
+PROVISIONING_WORKERS = 4
+JOBS_DB = "jobs.db"
+# how many manifest rows the bulk endpoint and command provision at once, and the ?concurrency= cap
+BULK_CONCURRENCY = 5
+BULK_MAX_CONCURRENCY = 20
+# "api" registers new stacks with one Pulumi Cloud REST call, "cli" through the Automation API
+PROVISIONING_MODE = "api"
+# how often in-flight deployments are polled, and how many are fetched at once
+DEPLOYMENT_STATUS_INTERVAL_SECONDS = 5
+DEPLOYMENT_STATUS_BATCH_SIZE = 10
+# account directory page size, and the cap for ?per_page=
+ACCOUNTS_PER_PAGE = 50
+ACCOUNTS_MAX_PER_PAGE = 200
+# deployments dispatched per second per Pulumi org (with bursts up to DEPLOYMENT_BURST), and how many may run at once
+DEPLOYMENT_RATE_PER_SECOND = 1
+DEPLOYMENT_BURST = 5
+DEPLOYMENT_MAX_RUNNING = 10
+# "memory" keeps the directory in an in-process cache of the stack listing, "sqlite" in a
+# persistent table in the instance dir that Pulumi Cloud webhooks keep current
+ACCOUNT_INVENTORY = "memory"
+ACCOUNTS_DB = "accounts.db"
+# shared secret of the Pulumi Cloud webhook posting to /webhooks/pulumi, which answers 404 until it is set
+PULUMI_WEBHOOK_SECRET = None
+# the stack output holding the AWS account ID
+ACCOUNT_ID_OUTPUT = "accountId"
+# how many stacks `rollout-settings` checks and updates at once, and where it keeps its progress
+ROLLOUT_CONCURRENCY = 10
+ROLLOUT_CHECKPOINT = "rollout.jsonl"
+# where provisioning timelines are recorded (instance dir), and the request-to-deployed SLO they're held to
+TIMELINE_FILE = "timeline.jsonl"
+PROVISIONING_SLO_SECONDS = 1800
+# `drift-scan`: the deployment operation that checks a stack, how many run at once, how long one may take,
+# and where the summary the index page shows is kept (instance dir)
+DRIFT_OPERATION = "detect-drift"
+DRIFT_CONCURRENCY = 10
+DRIFT_TIMEOUT_SECONDS = 1800
+DRIFT_SUMMARY = "drift.json"
+# how long the delete request waits for its deployment to go out before leaving it queued
+DEPLOYMENT_DISPATCH_WAIT_SECONDS = 5
+# how often the dispatcher checks an org's running deployments while it is at DEPLOYMENT_MAX_RUNNING,
+# and how long a provisioning job or drift check waits for room before giving up
+DEPLOYMENT_RUNNING_POLL_SECONDS = 5
+DEPLOYMENT_DISPATCH_TIMEOUT_SECONDS = 600
@@ -0,0 +1,106 @@
+"""
+The Pulumi Deployments settings for an account stack, shared by the web app
+and the lambda so both configure accounts the same way.
+"""
+
+import shlex
+
+import timeline
+
+
+def stack_config(name, email, first_name, last_name, ou, ou_id_on_delete):
+    """the config the account program reads, in the order it used to be set"""
+    return {
+        "name": name,
+        "email": email,
+        "organizationalUnit": ou,
+        "organizationalUnitIdOnDelete": ou_id_on_delete,
+        "ssoEmail": email,
+        "ssoFirstName": first_name,
+        "ssoLastName": last_name,
+    }
+
+
+def config_command(stack: str, config: dict):
+    """
+    Sets every config value with one `pulumi config set-all`, so the deployment
+    starts the CLI once instead of once per value.
+    """
+    pairs = " ".join(
+        f"--plaintext {shlex.quote(f'{key}={value}')}" for key, value in config.items()
+    )
+    return f"pulumi config set-all {pairs} -s {stack}"
+
+
+def deployment_settings(
+    *,
+    pulumi_org: str,
+    name: str,
+    email: str,
+    first_name: str,
+    last_name: str,
+    ou: str,
+    ou_id_on_delete: str,
+    git_org: str,
+    git_repo: str,
+    git_branch: str,
+    oidc_role_arn: str,
+    aws_region: str = "us-west-2",
+    correlation_id: str = None,
+):
+    """the body posted to .../deployments/settings for one account stack"""
+    config = stack_config(name, email, first_name, last_name, ou, ou_id_on_delete)
+    environment = {"AWS_REGION": aws_region}
+    if correlation_id:
+        environment[timeline.CORRELATION_ENV] = correlation_id
+    return {
+        "sourceContext": {"git": {"branch": f"refs/heads/{git_branch}"}},
+        "gitHub": {
+            "repository": f"{git_org}/{git_repo}",
+            "deployCommits": True,
+            "previewPullRequests": True,
+        },
+        "operationContext": {
+            "preRunCommands": [config_command(f"{pulumi_org}/{name}", config)],
+            "oidc": {
+                "aws": {
+                    "roleArn": oidc_role_arn,
+                    "sessionName": "deployment",
+                }
+            },
+            "environmentVariables": environment,
+        },
+    }
+
+
+def parse_config_commands(commands):
+    """
+    Recovers the config an account's preRunCommands set, from either the
+    single `config set-all` or the older one `config set` per value.
+    """
+    config = {}
+    for command in commands or []:
+        args = shlex.split(command)
+        if args[:3] == ["pulumi", "config", "set-all"]:
+            for flag, pair in zip(args[3:], args[4:]):
+                if flag in ("--plaintext", "--secret") and "=" in pair:
+                    key, _, value = pair.partition("=")
+                    config[key] = value
+        elif args[:3] == ["pulumi", "config", "set"] and len(args) >= 5:
+            config[args[3]] = args[4]
+    return config
+
+
+def drift(current, desired, path=""):
+    """
+    Returns the paths where `current` differs from `desired`. Only the keys
+    `desired` sets are compared, the service adds fields of its own.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return [path or "."]
+        changes = []
+        for key, value in desired.items():
+            changes += drift(current.get(key), value, f"{path}.{key}" if path else key)
+        return changes
+    return [] if current == desired else [path]
@@ -0,0 +1,180 @@
+"""
+Tracks the status of deployments the app has dispatched.
+
+One background poller fetches the status of every in-flight deployment in
+bounded batches and caches it, and changes are pushed to any index pages that
+are listening on the server-sent events stream. Operators get live status
+without reloading the page.
+"""
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED = frozenset(["succeeded", "failed", "skipped"])
+# the deployment's status couldn't be fetched any more (e.g. a 404 once a delete
+# deployment removed its stack), so it stops being polled
+UNKNOWN = "unknown"
+STOPPED = FINISHED | {UNKNOWN}
+
+
+def _not_found(exn):
+    return getattr(getattr(exn, "response", None), "status_code", None) == 404
+
+
+class DeploymentStatusPoller:
+    def __init__(
+        self,
+        fetch,
+        interval: float = 5,
+        batch_size: int = 10,
+        on_finished=None,
+        max_errors: int = 5,
+        retention: float = 3600,
+    ):
+        # fetch(stack_name, deployment_id) returns the deployment's status string
+        self._fetch = fetch
+        # called with the status dict once a deployment has finished
+        self._on_finished = on_finished
+        self.interval = interval
+        self.batch_size = batch_size
+        # consecutive failed fetches before a deployment is given up on
+        self.max_errors = max_errors
+        # seconds a stopped deployment's status is kept for the index page
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._statuses = {}
+        self._subscribers = []
+        self._wake = threading.Event()
+        self._thread = None
+
+    def track(
+        self,
+        stack: str,
+        deployment_id: str,
+        operation: str,
+        status="accepted",
+        correlation_id: str = None,
+    ):
+        """starts following a freshly dispatched deployment"""
+        self._set(
+            stack,
+            {
+                "stack": stack,
+                "id": deployment_id,
+                "operation": operation,
+                "status": status,
+                "correlation_id": correlation_id,
+                "updated_at": time.time(),
+            },
+        )
+        self.start()
+        self._wake.set()
+
+    def statuses(self):
+        with self._lock:
+            return {stack: dict(status) for stack, status in self._statuses.items()}
+
+    def in_flight(self):
+        with self._lock:
+            return [
+                dict(status)
+                for status in self._statuses.values()
+                if status["status"] not in STOPPED
+            ]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="deployment-status", daemon=True
+            )
+        self._thread.start()
+
+    def poll(self):
+        """fetches the status of every in-flight deployment once"""
+        self._expire()
+        pending = self.in_flight()
+        if not pending:
+            return
+
+        def fetch(status):
+            try:
+                return status, self._fetch(status["stack"], status["id"]), None
+            except Exception as exn:
+                print(f"Error fetching deployment status for {status['stack']}: {exn}")
+                return status, None, exn
+
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            for status, new, exn in executor.map(fetch, pending):
+                if exn is not None:
+                    errors = status.get("errors", 0) + 1
+                    if _not_found(exn) or errors >= self.max_errors:
+                        new = UNKNOWN
+                    else:
+                        self._update(status["stack"], status, errors=errors)
+                        continue
+                if new and new != status["status"]:
+                    status = dict(status, status=new, errors=0, updated_at=time.time())
+                    self._set(status["stack"], status)
+                    if new in FINISHED and self._on_finished:
+                        self._on_finished(status)
+                elif status.get("errors"):
+                    self._update(status["stack"], status, errors=0)
+
+    def _update(self, stack: str, status: dict, **fields):
+        """changes bookkeeping fields without notifying subscribers"""
+        with self._lock:
+            # a newer deployment may have replaced it while it was fetched
+            if self._statuses.get(stack, {}).get("id") == status["id"]:
+                self._statuses[stack] = dict(self._statuses[stack], **fields)
+
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for stack, status in list(self._statuses.items()):
+                if status["status"] in STOPPED and status["updated_at"] < cutoff:
+                    del self._statuses[stack]
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.poll()
+
+    def _set(self, stack: str, status: dict):
+        with self._lock:
+            self._statuses[stack] = status
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(status)
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.remove(subscriber)
+
+    def stream(self, heartbeat: float = 15):
+        """yields a server-sent event per status change until the client goes away"""
+        subscriber = self.subscribe()
+        try:
+            for status in self.statuses().values():
+                yield f"data: {json.dumps(status)}\n\n"
+            while True:
+                try:
+                    status = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    # keeps proxies from closing an idle connection
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"data: {json.dumps(status)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
@@ -0,0 +1,272 @@
+"""
+Paces deployment dispatches to what Pulumi Deployments will accept.
+
+Creates, deletes and the lambda used to POST to /deployments as soon as they
+were ready, so a bulk import would run into the organization's concurrency
+limit and get 429s. Every dispatch now goes through a DeploymentScheduler,
+which per organization
+
+- spends a token from a token bucket, so requests go out at a steady rate,
+- keeps at most `max_running` dispatched deployments unfinished, polling
+  their status once the cap is reached,
+- and picks the most urgent request first, so offboarding deletes don't wait
+  behind a queue of routine creates.
+
+Callers that can't wait for a full org (a web request, a lambda with a
+timeout) use `dispatch`, which withdraws a request still queued after
+`timeout` seconds and raises DispatchTimeout.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# lower goes first
+URGENT = 0
+ROUTINE = 1
+# operations that go ahead of everything else unless told otherwise
+URGENT_OPERATIONS = ("delete", "destroy")
+FINISHED = ("succeeded", "failed", "skipped")
+
+
+class DispatchTimeout(Exception):
+    """the deployment was still queued when the caller stopped waiting"""
+
+
+def _not_found(exn):
+    return getattr(getattr(exn, "response", None), "status_code", None) == 404
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """takes a token and returns 0, or returns how long until there is one"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+
+class DeploymentScheduler:
+    def __init__(
+        self,
+        dispatch,
+        fetch_status,
+        rate=1.0,
+        burst=5,
+        max_running=10,
+        poll_interval=5,
+        retry_after=10,
+        max_status_errors=5,
+    ):
+        # dispatch(org, project, stack, operation) returns the API response
+        self._dispatch = dispatch
+        # fetch_status(org, project, stack, deployment_id) returns its status
+        self._fetch_status = fetch_status
+        self.rate = rate
+        self.burst = burst
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        # seconds to hold a request back after a 429 without a Retry-After
+        self.retry_after = retry_after
+        # a running deployment whose status can't be fetched this many times in
+        # a row (or is a 404) stops counting against the cap
+        self.max_status_errors = max_status_errors
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        # org -> heap of (priority, seq, not_before, request, future)
+        self._queues = {}
+        self._buckets = {}
+        # org -> {deployment_id: (project, stack)} dispatched but not finished
+        self._running = {}
+        self._polled_at = {}
+        # deployment_id -> consecutive failed status fetches
+        self._status_errors = {}
+        self._thread = None
+
+    def submit(self, org, project, stack, operation, priority=None):
+        """
+        Queues a deployment and returns a Future for the API's response to
+        dispatching it.
+        """
+        if priority is None:
+            priority = URGENT if operation in URGENT_OPERATIONS else ROUTINE
+        future = Future()
+        with self._cond:
+            heapq.heappush(
+                self._queues.setdefault(org, []),
+                (priority, next(self._seq), 0, (project, stack, operation), future),
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="deployment-dispatch", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def dispatch(self, org, project, stack, operation, timeout, priority=None):
+        """
+        Submits a deployment and waits up to `timeout` seconds for the API's
+        response. A request that is still queued by then (the org is at its
+        cap or out of tokens) is withdrawn and DispatchTimeout is raised, so
+        the caller can fail and be retried instead of hanging. One that is
+        being sent is waited for, the client's own timeouts bound that.
+        """
+        future = self.submit(org, project, stack, operation, priority)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            pass
+        while True:
+            if self.withdraw(org, future):
+                raise DispatchTimeout(
+                    f"deployment of '{stack}' still queued after {timeout}s, "
+                    f"{self.running(org)} deployments running in '{org}'"
+                )
+            try:
+                # it may be requeued after a 429, check again shortly
+                return future.result(1)
+            except FutureTimeoutError:
+                continue
+
+    def withdraw(self, org, future):
+        """takes a request off the queue, False if it isn't queued (any more)"""
+        with self._cond:
+            queue = self._queues.get(org, [])
+            for i, entry in enumerate(queue):
+                if entry[4] is future:
+                    queue.pop(i)
+                    heapq.heapify(queue)
+                    future.cancel()
+                    return True
+        return False
+
+    def queued(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def running(self, org):
+        with self._cond:
+            return len(self._running.get(org, {}))
+
+    def _run(self):
+        while True:
+            org, entry = self._next()
+            priority, seq, _, (project, stack, operation), future = entry
+            try:
+                r = self._dispatch(org, project, stack, operation)
+            except Exception as exn:
+                future.set_exception(exn)
+                continue
+
+            if r.status_code == 429:
+                # the client already retried, back off the whole org
+                wait = _retry_after(r) or self.retry_after
+                with self._cond:
+                    self._bucket(org).drain()
+                    heapq.heappush(
+                        self._queues.setdefault(org, []),
+                        (priority, seq, time.monotonic() + wait, entry[3], future),
+                    )
+                continue
+
+            if r.ok:
+                try:
+                    deployment_id = r.json()["id"]
+                except (ValueError, KeyError):
+                    deployment_id = None
+                if deployment_id:
+                    with self._cond:
+                        running = self._running.setdefault(org, {})
+                        running[deployment_id] = (project, stack)
+            future.set_result(r)
+
+    def _next(self):
+        """waits for the most urgent request whose org has room, and pops it"""
+        while True:
+            self._poll_full_orgs()
+            with self._cond:
+                now = time.monotonic()
+                ready, wait = None, None
+                for org, queue in self._queues.items():
+                    if not queue:
+                        continue
+                    head = queue[0]
+                    if len(self._running.get(org, {})) >= self.max_running:
+                        delay = self.poll_interval
+                    elif head[2] > now:
+                        delay = head[2] - now
+                    else:
+                        delay = 0
+                    if delay == 0 and (ready is None or head < ready[1]):
+                        ready = (org, head)
+                    elif delay:
+                        wait = delay if wait is None else min(wait, delay)
+
+                if ready is not None:
+                    org, head = ready
+                    delay = self._bucket(org).take()
+                    if delay == 0:
+                        return org, heapq.heappop(self._queues[org])
+                    wait = delay if wait is None else min(wait, delay)
+                self._cond.wait(wait)
+
+    def _poll_full_orgs(self):
+        """refreshes the running deployments of orgs that are at the cap"""
+        now = time.monotonic()
+        with self._cond:
+            due = [
+                (org, dict(running))
+                for org, running in self._running.items()
+                if len(running) >= self.max_running
+                and now - self._polled_at.get(org, 0) >= self.poll_interval
+            ]
+        for org, running in due:
+            finished = []
+            for deployment_id, (project, stack) in running.items():
+                try:
+                    status = self._fetch_status(org, project, stack, deployment_id)
+                except Exception as exn:
+                    print(f"Error polling deployment {deployment_id}: {exn}")
+                    errors = self._status_errors.get(deployment_id, 0) + 1
+                    self._status_errors[deployment_id] = errors
+                    if _not_found(exn) or errors >= self.max_status_errors:
+                        finished.append(deployment_id)
+                    continue
+                self._status_errors.pop(deployment_id, None)
+                if status in FINISHED:
+                    finished.append(deployment_id)
+            with self._cond:
+                self._polled_at[org] = time.monotonic()
+                for deployment_id in finished:
+                    self._running[org].pop(deployment_id, None)
+                    self._status_errors.pop(deployment_id, None)
+
+    def _bucket(self, org):
+        bucket = self._buckets.get(org)
+        if bucket is None:
+            bucket = self._buckets[org] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+
+def _retry_after(r):
+    try:
+        return float(r.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,147 @@
+"""
+Drift scans across every account stack.
+
+Checking stacks one at a time through the Automation API makes a scan take
+as long as all of their refreshes added up. A scan instead dispatches a
+deployment that refreshes each stack without applying anything, keeps at
+most `concurrency` of them in flight, and reads each one's resource changes
+as it finishes, so the whole fleet takes about as long as its slowest few
+deployments. Results go to a summary file as they come in, which the index
+page reads.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+FINISHED = frozenset(["succeeded", "failed", "skipped"])
+
+IN_SYNC = "in_sync"
+DRIFTED = "drifted"
+FAILED = "failed"
+
+# the resource change counts that don't mean a resource drifted
+UNCHANGED = frozenset(["same"])
+
+
+def timestamp(at=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(at))
+
+
+def drifted(changes):
+    return any(count for op, count in (changes or {}).items() if op not in UNCHANGED)
+
+
+class Summary:
+    """the latest scan's results, in a JSON file that is replaced whole"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._summary = None
+
+    def load(self):
+        """returns the summary, only reading the file again after it changed"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key != self._stat:
+                try:
+                    with open(self.path) as f:
+                        self._summary = json.load(f)
+                    self._stat = key
+                except (OSError, ValueError):
+                    pass
+            return self._summary
+
+    def save(self, summary: dict):
+        # written aside and renamed, so readers never see half a file
+        partial = f"{self.path}.partial"
+        with open(partial, "w") as f:
+            json.dump(summary, f, indent=2)
+        os.replace(partial, self.path)
+
+
+def scan(
+    names,
+    dispatch,
+    fetch_deployment,
+    fetch_changes,
+    concurrency: int = 10,
+    poll_interval: float = 5,
+    timeout: float = 1800,
+):
+    """
+    Checks every stack for drift with at most `concurrency` deployments in
+    flight, yielding a result per stack as its deployment finishes.
+
+    `dispatch(name)` starts the stack's drift deployment and returns its ID,
+    `fetch_deployment(name, deployment_id)` returns the deployment (a dict
+    with at least its "status"), and `fetch_changes(name, deployment)` the
+    resource changes a finished one found, as counts per operation.
+    """
+
+    def run(name):
+        started = time.monotonic()
+        deployment_id = dispatch(name)
+        while True:
+            time.sleep(poll_interval)
+            deployment = fetch_deployment(name, deployment_id)
+            if deployment["status"] in FINISHED:
+                break
+            if time.monotonic() - started > timeout:
+                raise TimeoutError(f"deployment {deployment_id} is still running")
+
+        result = {
+            "deployment_id": deployment_id,
+            "seconds": round(time.monotonic() - started, 2),
+        }
+        if deployment["status"] != "succeeded":
+            return {**result, "status": FAILED, "error": deployment["status"]}
+        changes = fetch_changes(name, deployment)
+        status = DRIFTED if drifted(changes) else IN_SYNC
+        return {**result, "status": status, "changes": changes}
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="drift"
+    ) as executor:
+        futures = {executor.submit(run, name): name for name in names}
+        for future in as_completed(futures):
+            result = {"name": futures[future], "checked_at": timestamp()}
+            try:
+                result.update(future.result())
+            except Exception as exn:
+                result.update({"status": FAILED, "error": str(exn)})
+            yield result
+
+
+def scan_into(summary: Summary, names, **kwargs):
+    """
+    Runs a scan and saves the summary after every result. Stacks keep their
+    previous result until they have been checked again, stacks that are gone
+    are dropped.
+    """
+    names = list(names)
+    previous = (summary.load() or {}).get("stacks") or {}
+    stacks = {name: previous[name] for name in names if name in previous}
+    state = {"started_at": timestamp(), "finished_at": None, "stacks": stacks}
+
+    def save():
+        counts = {}
+        for result in stacks.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        summary.save({**state, "counts": counts})
+
+    save()
+    for result in scan(names, **kwargs):
+        stacks[result["name"]] = result
+        save()
+        yield result
+    state["finished_at"] = timestamp()
+    save()
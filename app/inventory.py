@@ -0,0 +1,246 @@
+import bisect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AccountInventory:
+    """
+    An in-process cache of the account stacks.
+
+    Listing stacks through the Automation API starts the pulumi CLI, so we keep
+    the last listing in memory and refresh it in the background once it is older
+    than `ttl` seconds. Handlers that create or delete accounts patch the cache
+    straight away so the index page doesn't have to wait for the next refresh.
+
+    Names and emails are also kept in sorted indexes so the directory can
+    be searched by prefix and paged without walking every account. A request
+    only fetches the per-stack details of the accounts on the page being
+    shown; the rest are fetched off the request path after each refresh, to
+    fill in the email index.
+    """
+
+    def __init__(self, loader, ttl=60, details_loader=None, index_workers=4):
+        # loader returns a list of dicts with at least a "name" key
+        self._loader = loader
+        # details_loader(name) returns extra fields (e.g. "email") for one account
+        self._details_loader = details_loader
+        # how many details the background email indexing fetches at once
+        self.index_workers = index_workers
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._accounts = {}
+        # details survive refreshes, they don't change once fetched
+        self._details = {}
+        self._names = []
+        # (lowercased key, name) pairs, searched by prefix with bisect
+        self._name_keys = []
+        self._emails = []
+        self._loaded_at = None
+        self._refreshing = False
+        self._indexing = False
+        self._last_error = None
+        # local changes made while a refresh is in flight, replayed on top of it
+        self._patches = []
+
+    def list(self):
+        """returns the cached accounts sorted by name, loading them on first use"""
+        self._ensure_loaded()
+        with self._lock:
+            return [self._account(name) for name in self._names]
+
+    def page(self, query="", page=1, per_page=50, descending=False):
+        """
+        Returns one page of accounts whose name or email starts with `query`,
+        sorted by name, along with the total number of matches. Emails match
+        once the background indexing after a refresh has fetched them.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            names = self._search(query.lower()) if query else self._names
+            total = len(names)
+            if descending:
+                start = max(0, total - page * per_page)
+                selected = names[start : total - (page - 1) * per_page][::-1]
+            else:
+                selected = names[(page - 1) * per_page : page * per_page]
+
+        self._load_details(selected)
+        with self._lock:
+            return [self._account(name) for name in selected], total
+
+    def exists(self, name):
+        """
+        Whether the account is in the cache, loading it first if nothing has
+        been loaded yet. A failed load counts as unknown (False), the create
+        itself still refuses a duplicate.
+        """
+        try:
+            self._ensure_loaded()
+        except Exception as exn:
+            print(f"Error loading account inventory: {exn}")
+        with self._lock:
+            return name in self._accounts
+
+    def refresh(self):
+        """reloads the inventory synchronously"""
+        with self._lock:
+            self._refreshing = True
+        started = time.monotonic()
+        try:
+            accounts = self._loader()
+        except Exception as exn:
+            with self._lock:
+                self._refreshing = False
+                self._last_error = exn
+                # don't hammer a failing backend on every page load
+                self._loaded_at = started
+            raise
+
+        with self._lock:
+            self._accounts = {account["name"]: dict(account) for account in accounts}
+            for patched_at, op, name, fields in self._patches:
+                if patched_at >= started:
+                    self._apply(op, name, fields)
+            self._patches = [p for p in self._patches if p[0] >= started]
+            self._details = {
+                name: details
+                for name, details in self._details.items()
+                if name in self._accounts
+            }
+            self._reindex()
+            self._loaded_at = started
+            self._refreshing = False
+            self._last_error = None
+        self._index_emails_async()
+
+    def refresh_async(self):
+        """starts a background refresh unless one is already running"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as exn:
+                print(f"Error refreshing account inventory: {exn}")
+
+        threading.Thread(target=run, name="inventory-refresh", daemon=True).start()
+
+    def _index_emails_async(self):
+        """fetches the details of accounts whose email isn't known yet"""
+        if self._details_loader is None:
+            return
+        with self._lock:
+            if self._indexing:
+                return
+            self._indexing = True
+
+        def run():
+            try:
+                with self._lock:
+                    names = [name for name in self._names if name not in self._details]
+                self._load_details(names, workers=self.index_workers)
+            finally:
+                with self._lock:
+                    self._indexing = False
+
+        threading.Thread(target=run, name="inventory-emails", daemon=True).start()
+
+    def invalidate(self):
+        """marks the cache stale and refreshes it in the background"""
+        with self._lock:
+            if self._loaded_at is not None:
+                self._loaded_at = time.monotonic() - self._ttl - 1
+        self.refresh_async()
+
+    def add(self, name, **fields):
+        self._patch("add", name, fields)
+
+    def remove(self, name):
+        self._patch("remove", name, {})
+
+    def _ensure_loaded(self):
+        with self._lock:
+            loaded = self._loaded_at is not None
+            stale = loaded and time.monotonic() - self._loaded_at > self._ttl
+
+        if not loaded:
+            self.refresh()
+        elif stale:
+            self.refresh_async()
+
+        with self._lock:
+            if self._last_error and not self._accounts:
+                raise self._last_error
+
+    def _load_details(self, names, workers=10):
+        if self._details_loader is None:
+            return
+        with self._lock:
+            missing = [name for name in names if name not in self._details]
+        if not missing:
+            return
+
+        def load(name):
+            try:
+                return name, self._details_loader(name)
+            except Exception as exn:
+                print(f"Error loading details for account '{name}': {exn}")
+                return name, None
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            loaded = [(name, d) for name, d in executor.map(load, missing) if d]
+
+        with self._lock:
+            for name, details in loaded:
+                self._details[name] = details
+            self._reindex()
+
+    def _search(self, prefix):
+        # every key starting with prefix sorts between prefix and prefix + U+FFFF
+        end = (prefix + "\uffff",)
+        matches = set()
+        for index in (self._name_keys, self._emails):
+            start = bisect.bisect_left(index, (prefix,))
+            stop = bisect.bisect_left(index, end)
+            matches.update(name for _, name in index[start:stop])
+        return sorted(matches)
+
+    def _account(self, name):
+        account = dict(self._accounts[name])
+        for key, value in self._details.get(name, {}).items():
+            account.setdefault(key, value)
+        return account
+
+    def _email(self, name):
+        return self._accounts[name].get("email") or self._details.get(
+            name, {}
+        ).get("email")
+
+    def _reindex(self):
+        self._name_keys = sorted((name.lower(), name) for name in self._accounts)
+        self._names = [name for _, name in self._name_keys]
+        emails = []
+        for name in self._names:
+            email = self._email(name)
+            if email:
+                emails.append((email.lower(), name))
+        self._emails = sorted(emails)
+
+    def _patch(self, op, name, fields):
+        with self._lock:
+            self._apply(op, name, fields)
+            self._reindex()
+            if self._refreshing:
+                self._patches.append((time.monotonic(), op, name, fields))
+
+    def _apply(self, op, name, fields):
+        if op == "add":
+            account = self._accounts.setdefault(name, {"name": name})
+            account.update(fields)
+        elif op == "remove":
+            self._accounts.pop(name, None)
+            self._details.pop(name, None)
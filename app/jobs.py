@@ -0,0 +1,189 @@
+"""
+Background provisioning jobs.
+
+Provisioning an account takes several CLI launches and API calls, so web
+handlers hand the work to a small worker pool and return a job ID instead.
+Jobs and the status of each of their phases are kept in a local SQLite file so
+they survive a restart and can be looked up from any worker thread.
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    phases TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)"
+            )
+
+    def create(self, kind: str, params: dict):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+                (job_id, kind, json.dumps(params), QUEUED, "[]", now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    def with_status(self, *statuses: str):
+        marks = ", ".join("?" for _ in statuses)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM jobs WHERE status IN ({marks}) ORDER BY created_at",
+                statuses,
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def update(self, job_id: str, status: str, result=None, error: str = None):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (status, json.dumps(result), error, time.time(), job_id),
+            )
+
+    def set_phase(self, job_id: str, name: str, status: str, **details):
+        """adds or updates one phase entry of a job, keeping the phases in order"""
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT phases FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            phases = json.loads(row["phases"])
+            for phase in phases:
+                if phase["name"] == name:
+                    break
+            else:
+                phase = {"name": name}
+                phases.append(phase)
+            phase["status"] = status
+            phase.update(details)
+            self._db.execute(
+                "UPDATE jobs SET phases = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(phases), time.time(), job_id),
+            )
+
+    def _to_dict(self, row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["phases"] = json.loads(job["phases"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class Job:
+    """handed to job functions so they can report the progress of each phase"""
+
+    def __init__(self, store: JobStore, job_id: str, params: dict, on_phase=None):
+        self.store = store
+        self.id = job_id
+        self.params = params
+        self._on_phase = on_phase
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        self.store.set_phase(self.id, name, RUNNING)
+        try:
+            yield
+        except Exception as exn:
+            seconds = time.monotonic() - started
+            self.store.set_phase(
+                self.id, name, FAILED, seconds=round(seconds, 3), error=str(exn)
+            )
+            if self._on_phase is not None:
+                self._on_phase(name, seconds, FAILED)
+            raise
+        seconds = time.monotonic() - started
+        self.store.set_phase(self.id, name, SUCCEEDED, seconds=round(seconds, 3))
+        if self._on_phase is not None:
+            self._on_phase(name, seconds, SUCCEEDED)
+
+
+class JobQueue:
+    """
+    Runs jobs on a thread pool. `handlers` maps a job kind to a function that
+    takes a Job and returns a JSON serialisable result. `on_phase` is called
+    with (phase, seconds, status) whenever a phase finishes.
+    """
+
+    def __init__(
+        self, store: JobStore, handlers: dict, workers: int = 4, on_phase=None
+    ):
+        self.store = store
+        self.handlers = handlers
+        self.on_phase = on_phase
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="provisioning"
+        )
+
+    def submit(self, kind: str, params: dict):
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind '{kind}'")
+        job_id = self.store.create(kind, params)
+        self._executor.submit(self._run, job_id, kind, params)
+        return job_id
+
+    def run(self, kind: str, params: dict):
+        """runs a job in the calling thread, recording it like a queued one"""
+        job_id = self.store.create(kind, params)
+        self._run(job_id, kind, params)
+        return self.store.get(job_id)
+
+    def resume(self):
+        """
+        Re-queues jobs that were waiting when the process stopped. Jobs that were
+        half way through can't safely be replayed, so they are marked failed.
+        """
+        for job in self.store.with_status(RUNNING):
+            self.store.update(job["id"], FAILED, error="interrupted by a restart")
+        for job in self.store.with_status(QUEUED):
+            self._executor.submit(self._run, job["id"], job["kind"], job["params"])
+
+    def _run(self, job_id: str, kind: str, params: dict):
+        self.store.update(job_id, RUNNING)
+        try:
+            job = Job(self.store, job_id, params, self.on_phase)
+            result = self.handlers[kind](job)
+        except Exception as exn:
+            print(f"Job {job_id} ({kind}) failed: {exn}")
+            self.store.update(job_id, FAILED, error=str(exn))
+        else:
+            self.store.update(job_id, SUCCEEDED, result=result)
@@ -0,0 +1,183 @@
+"""
+Minimal metrics shared by the web app and the lambda.
+
+The app keeps counters, gauges and histograms in memory and renders them in
+the Prometheus text format on /metrics. The lambda has nothing to scrape, so
+it prints the same measurements as CloudWatch embedded metric format (EMF)
+log lines instead.
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+# seconds, spanning a quick API call up to a slow CLI refresh
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_labels(self.label_names, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """counts the block as in progress while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                value["buckets"][index] += 1
+            value["sum"] += seconds
+            value["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _render_value(self, key, value):
+        lines, cumulative = [], 0
+        names = self.label_names + ("le",)
+        for bound, count in zip(self.buckets, value["buckets"]):
+            cumulative += count
+            lines.append(
+                f"{self.name}_bucket{_labels(names, key + (bound,))} {cumulative}"
+            )
+        lines.append(
+            f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {value['count']}"
+        )
+        labels = _labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {value['sum']}")
+        lines.append(f"{self.name}_count{labels} {value['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """returns every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def emf(namespace, dimensions: dict, values: dict, unit="Milliseconds"):
+    """
+    Prints one CloudWatch embedded metric format line, which CloudWatch Logs
+    turns into metrics without any API calls from the function.
+    """
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": namespace,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit} for name in values
+                            ],
+                        }
+                    ],
+                },
+                **dimensions,
+                **values,
+            }
+        ),
+        flush=True,
+    )
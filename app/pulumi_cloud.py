@@ -0,0 +1,268 @@
+"""
+A small Pulumi Cloud REST client shared by the web app and the lambda.
+
+Both entry points talk to the same handful of endpoints, so they share one
+pooled session with timeouts, bounded retries and per-endpoint timings here
+instead of making bare `requests.post` calls.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+API_URL = "https://api.pulumi.com"
+
+# status codes that are worth another attempt
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# the server may have acted on a request that got anything else, so a POST is
+# only sent again after these
+RETRY_STATUSES_UNSENT = frozenset([429])
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+
+def never_sent(exn):
+    """whether a request failed before the server could have received it"""
+    if isinstance(exn, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exn.args[0], "reason", None) if exn.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _capped(timeout, seconds):
+    if isinstance(timeout, tuple):
+        return tuple(min(t, seconds) for t in timeout)
+    return min(timeout, seconds)
+
+
+class PulumiCloudClient:
+    def __init__(
+        self,
+        access_token: str,
+        api_url: str = API_URL,
+        timeout=(3.05, 20),
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        pool_size: int = 10,
+        on_request=None,
+        max_elapsed: float = None,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # seconds a call may take, retries and backoff included
+        self.max_elapsed = max_elapsed
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.headers = {"Authorization": f"token {access_token}"}
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timings = Timings()
+        # called with (endpoint, seconds, status) after every attempt, for metrics
+        self.on_request = on_request
+
+    def request(self, method: str, path: str, endpoint: str = None, **kwargs):
+        """
+        Sends a request, retrying with jittered exponential backoff. Idempotent
+        requests are retried on 429s, 5xxs, connection errors and timeouts;
+        POSTs only on 429s and on errors that happened before the request went
+        out, since the server may have acted on anything else. `endpoint`
+        names the route for the timings; it defaults to the path. Returns the
+        final response without raising for its status.
+        """
+        endpoint = endpoint or path
+        timeout = kwargs.pop("timeout", self.timeout)
+        url = f"{self.api_url}{path}"
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        retry_statuses = RETRY_STATUSES if idempotent else RETRY_STATUSES_UNSENT
+        deadline = self.max_elapsed and time.monotonic() + self.max_elapsed
+
+        attempt = 0
+        while True:
+            r = None
+            started = time.monotonic()
+            if deadline:
+                timeout = _capped(timeout, max(0.1, deadline - started))
+            try:
+                r = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as exn:
+                self._record(endpoint, time.monotonic() - started, "error")
+                if attempt >= self.max_retries or not (idempotent or never_sent(exn)):
+                    raise
+                delay = self._delay(attempt)
+                if deadline and time.monotonic() + delay >= deadline:
+                    raise
+            else:
+                self._record(endpoint, time.monotonic() - started, r.status_code)
+                if r.status_code not in retry_statuses or attempt >= self.max_retries:
+                    return r
+                delay = self._delay(attempt, r)
+                if deadline and time.monotonic() + delay >= deadline:
+                    return r
+            time.sleep(delay)
+            attempt += 1
+
+    def _record(self, endpoint: str, seconds: float, status):
+        self.timings.record(endpoint, seconds, status)
+        if self.on_request is not None:
+            self.on_request(endpoint, seconds, status)
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def _delay(self, attempt: int, response=None):
+        # honour Retry-After on 429s, otherwise use "full jitter" backoff
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return min(float(response.headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def stack_path(self, org: str, project: str, stack: str):
+        return f"/api/stacks/{org}/{project}/{stack}"
+
+    def list_stacks(self, org: str, project: str):
+        """
+        Lists the stacks of a project without starting the pulumi CLI.
+
+        The endpoint pages with a continuation token that is only returned with
+        the previous page, so pages are fetched one after the other. Stacks are
+        yielded as each page arrives so callers can start work before the
+        listing finishes.
+        """
+        params = {"organization": org, "project": project}
+        while True:
+            r = self.get("/api/user/stacks", params=params, endpoint="list_stacks")
+            r.raise_for_status()
+            response = r.json()
+
+            for stack in response.get("stacks") or []:
+                yield stack
+
+            token = response.get("continuationToken")
+            if not token:
+                return
+            params["continuationToken"] = token
+
+    def get_stack(self, org: str, project: str, stack: str):
+        return self.get(self.stack_path(org, project, stack), endpoint="get_stack")
+
+    def create_stack(self, org: str, project: str, stack: str, tags: dict = None):
+        """
+        Registers an empty stack, which is all the CLI's create + refresh of a
+        no-op program amounts to. Raises StackAlreadyExistsError on a 409.
+        """
+        r = self.post(
+            f"/api/stacks/{org}/{project}",
+            json={"stackName": stack, "tags": tags or {}},
+            endpoint="create_stack",
+        )
+        if r.status_code == 409:
+            raise StackAlreadyExistsError(
+                f"stack '{org}/{project}/{stack}' already exists"
+            )
+        r.raise_for_status()
+        return r
+
+    def export_stack(self, org: str, project: str, stack: str):
+        """returns the stack's latest checkpoint, resources and outputs included"""
+        return self.get(
+            f"{self.stack_path(org, project, stack)}/export", endpoint="export_stack"
+        )
+
+    def get_deployment_settings(self, org: str, project: str, stack: str):
+        return self.get(
+            f"{self.stack_path(org, project, stack)}/deployments/settings",
+            endpoint="get_deployment_settings",
+        )
+
+    def update_deployment_settings(
+        self, org: str, project: str, stack: str, settings: dict
+    ):
+        return self.post(
+            f"{self.stack_path(org, project, stack)}/deployments/settings",
+            json=settings,
+            endpoint="deployment_settings",
+        )
+
+    def create_deployment(self, org: str, project: str, stack: str, operation: str):
+        return self.post(
+            f"{self.stack_path(org, project, stack)}/deployments",
+            json={"operation": operation},
+            endpoint="deployments",
+        )
+
+    def get_deployment(self, org: str, project: str, stack: str, deployment_id: str):
+        return self.get(
+            f"{self.stack_path(org, project, stack)}/deployments/{deployment_id}",
+            endpoint="get_deployment",
+        )
+
+    def get_update(self, org: str, project: str, stack: str, version):
+        """returns an update's summary, including its resource change counts"""
+        return self.get(
+            f"{self.stack_path(org, project, stack)}/updates/{version}",
+            endpoint="get_update",
+        )
+
+
+class StackAlreadyExistsError(Exception):
+    pass
+
+
+class Timings:
+    """keeps latency samples per endpoint so slow calls are easy to spot"""
+
+    def __init__(self, samples: int = 500):
+        self._lock = threading.Lock()
+        self._samples = samples
+        self._endpoints = {}
+
+    def record(self, endpoint: str, seconds: float, status):
+        with self._lock:
+            stats = self._endpoints.setdefault(
+                endpoint,
+                {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "statuses": {},
+                    "recent": deque(maxlen=self._samples),
+                },
+            )
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            stats["recent"].append(seconds)
+
+    def summary(self):
+        """returns count, mean, p50, p95 and max latency in seconds per endpoint"""
+        with self._lock:
+            summary = {}
+            for endpoint, stats in self._endpoints.items():
+                recent = sorted(stats["recent"])
+                summary[endpoint] = {
+                    "count": stats["count"],
+                    "mean": stats["total"] / stats["count"],
+                    "p50": recent[len(recent) // 2],
+                    "p95": recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+                    "max": stats["max"],
+                    "statuses": dict(stats["statuses"]),
+                }
+            return summary
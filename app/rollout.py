@@ -0,0 +1,98 @@
+"""
+Rolls the current deployment settings template out to existing accounts.
+
+Deployment settings are written once, when an account is created, so a
+change to the OU, OIDC role, branch or region used to leave every existing
+stack on the old values. A rollout fetches every stack's settings
+concurrently, compares them with what the template produces now, and only
+updates the stacks that drifted. Finished stacks are appended to a
+checkpoint file so an interrupted rollout picks up where it stopped.
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import deployment_settings
+
+IN_SYNC = "in_sync"
+DRIFTED = "drifted"
+UPDATED = "updated"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class Checkpoint:
+    """
+    The stacks a rollout has finished, one JSON line each, after a header line
+    with the fingerprint of the template inputs. A checkpoint written for
+    other inputs is started over.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if lines and lines[0].get("fingerprint") == fingerprint:
+                self.done = {line["name"] for line in lines[1:]}
+        if not self.done:
+            with open(path, "w") as f:
+                f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+
+    def mark(self, name: str):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"name": name}) + "\n")
+            self.done.add(name)
+
+
+def rollout(
+    names,
+    fetch,
+    desired_for,
+    apply,
+    concurrency: int = 10,
+    checkpoint: Checkpoint = None,
+    dry_run: bool = False,
+):
+    """
+    Brings every stack's deployment settings in line with the template, with
+    at most `concurrency` stacks in flight, yielding a result per stack.
+
+    `fetch(name)` returns the stack's current settings, `desired_for(name,
+    current)` the settings it should have (or None when they can't be worked
+    out), and `apply(name, settings)` writes them.
+    """
+
+    def run(name):
+        current = fetch(name)
+        desired = desired_for(name, current)
+        if desired is None:
+            return {"status": SKIPPED, "error": "no settings to rebuild from"}
+        changes = deployment_settings.drift(current, desired)
+        if not changes:
+            return {"status": IN_SYNC}
+        if dry_run:
+            return {"status": DRIFTED, "changes": changes}
+        apply(name, desired)
+        return {"status": UPDATED, "changes": changes}
+
+    pending = [n for n in names if checkpoint is None or n not in checkpoint.done]
+    with ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="rollout"
+    ) as executor:
+        futures = {executor.submit(run, name): name for name in pending}
+        for future in as_completed(futures):
+            result = {"name": futures[future]}
+            try:
+                result.update(future.result())
+            except Exception as exn:
+                result.update({"status": FAILED, "error": str(exn)})
+            if checkpoint and not dry_run and result["status"] in (IN_SYNC, UPDATED):
+                checkpoint.mark(result["name"])
+            yield result
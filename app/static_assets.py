@@ -0,0 +1,87 @@
+"""
+Fingerprinted, precompressed static assets.
+
+Only the minified bootstrap builds are published. Each is copied to the
+build dir under a name that includes a hash of its content, next to gzip
+and (if the brotli package is installed) brotli variants compressed once at
+maximum level. A file's URL changes whenever its content does, so it can be
+cached forever, and each request is answered with the smallest variant the
+client accepts.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the files pages link to, relative to the static dir
+ASSETS = ("bootstrap.min.css", "bootstrap.min.js")
+MANIFEST = "manifest.json"
+# preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def fingerprinted(name: str, data: bytes):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def build(static_dir: str, build_dir: str):
+    """writes every asset and its compressed variants, returns the manifest"""
+    os.makedirs(build_dir, exist_ok=True)
+    manifest = {}
+    for name in ASSETS:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        target = fingerprinted(name, data)
+        manifest[name] = target
+
+        variants = {"": data, ".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(data, quality=11)
+        for suffix, content in variants.items():
+            path = os.path.join(build_dir, target + suffix)
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(content)
+
+    with open(os.path.join(build_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(static_dir: str, build_dir: str):
+    """returns the build's manifest, rebuilding it if an asset has changed"""
+    try:
+        with open(os.path.join(build_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        built_at = os.path.getmtime(os.path.join(build_dir, MANIFEST))
+        sources = (os.path.join(static_dir, name) for name in ASSETS)
+        if set(manifest) == set(ASSETS) and all(
+            os.path.getmtime(source) <= built_at for source in sources
+        ):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return build(static_dir, build_dir)
+
+
+def pick_variant(build_dir: str, filename: str, accept_encoding: str):
+    """returns (filename, content encoding) of the best variant to send"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip().lower())
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.exists(
+            os.path.join(build_dir, filename + suffix)
+        ):
+            return filename + suffix, encoding
+    return filename, None
@@ -0,0 +1,185 @@
+"""
+Provisioning timelines, from directory event to finished deployment.
+
+Each request to provision an account gets a correlation ID where it enters
+the system (the webhook in the lambda, create_account in the web app). The
+ID is tagged on the stack and passed to the deployment as an environment
+variable, and every stage it goes through is recorded as a JSON line on
+stdout (CloudWatch Logs for the lambda) and, if a path is configured, in a
+local file. `report` turns those lines back into per-stage and end-to-end
+latency distributions and lists the accounts that missed the SLO.
+"""
+
+import datetime
+import json
+import threading
+import time
+import uuid
+
+CORRELATION_TAG = "vending:correlation-id"
+# the deployment sees its correlation ID in this environment variable
+CORRELATION_ENV = "VENDING_CORRELATION_ID"
+
+# in the order an account goes through them
+RECEIVED = "received"
+STARTED = "started"
+STACK_CREATED = "stack_created"
+SETTINGS_WRITTEN = "settings_written"
+DEPLOYMENT_DISPATCHED = "deployment_dispatched"
+DEPLOYMENT_FINISHED = "deployment_finished"
+STAGES = (
+    RECEIVED,
+    STARTED,
+    STACK_CREATED,
+    SETTINGS_WRITTEN,
+    DEPLOYMENT_DISPATCHED,
+    DEPLOYMENT_FINISHED,
+)
+# the event turned out not to need an account (a duplicate, a delete, ...), so
+# its timeline ends without one and is left out of the report
+NOT_PROVISIONED = "not_provisioned"
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+class Timeline:
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, correlation_id: str, stage: str, at: float = None, **fields):
+        if not correlation_id:
+            return
+        line = json.dumps(
+            {
+                "timeline": stage,
+                "correlation_id": correlation_id,
+                "at": at or time.time(),
+                **fields,
+            }
+        )
+        print(line, flush=True)
+        if self.path:
+            with self._lock, open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+def parse_time(value):
+    """reads an API timestamp (ISO 8601 or epoch seconds) as epoch seconds"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def load(lines):
+    """
+    Groups timeline lines by correlation ID. Other lines are skipped, and
+    anything before the JSON (e.g. a CloudWatch Logs prefix) is ignored.
+    """
+    timelines = {}
+    for line in lines:
+        start = line.find("{")
+        if start < 0:
+            continue
+        try:
+            event = json.loads(line[start:])
+        except ValueError:
+            continue
+        if not isinstance(event, dict):
+            continue
+        stage = event.get("timeline")
+        if stage not in STAGES and stage != NOT_PROVISIONED:
+            continue
+        timeline = timelines.setdefault(event["correlation_id"], {"stages": {}})
+        if stage == NOT_PROVISIONED:
+            timeline["not_provisioned"] = True
+            continue
+        # the first time a stage was reached counts, retries don't reset it
+        stages = timeline["stages"]
+        stages[stage] = min(event["at"], stages.get(stage, event["at"]))
+        for key in ("stack", "deployment_id"):
+            if event.get(key):
+                timeline[key] = event[key]
+    return timelines
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+
+    def at(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))], 2)
+
+    return {
+        "n": len(samples),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": round(samples[-1], 2),
+    }
+
+
+def report(timelines, slo_seconds: float, fetch_finished=None):
+    """
+    Returns the latency (in seconds) of every stage, measured from the stage
+    before it, and of the whole timeline, plus the timelines over the SLO.
+
+    `fetch_finished(stack, deployment_id)` can fill in when a deployment
+    finished for timelines that were never seen to finish; it returns epoch
+    seconds or None while the deployment is still running.
+    """
+    stage_samples = {stage: [] for stage in STAGES[1:]}
+    totals, breaches, unfinished = [], [], 0
+    now = time.time()
+
+    for correlation_id, timeline in timelines.items():
+        stages = timeline["stages"]
+        if timeline.get("not_provisioned") and STARTED not in stages:
+            continue
+        if (
+            DEPLOYMENT_FINISHED not in stages
+            and fetch_finished
+            and timeline.get("deployment_id")
+        ):
+            finished = fetch_finished(timeline["stack"], timeline["deployment_id"])
+            if finished:
+                stages[DEPLOYMENT_FINISHED] = finished
+
+        reached = [stage for stage in STAGES if stage in stages]
+        for previous, stage in zip(reached, reached[1:]):
+            stage_samples[stage].append(stages[stage] - stages[previous])
+
+        start = stages[reached[0]]
+        if DEPLOYMENT_FINISHED in stages:
+            total = stages[DEPLOYMENT_FINISHED] - start
+            totals.append(total)
+        else:
+            unfinished += 1
+            # still counts against the SLO while it is running
+            total = now - start
+        if total > slo_seconds:
+            breaches.append(
+                {
+                    "correlation_id": correlation_id,
+                    "stack": timeline.get("stack"),
+                    "seconds": round(total, 2),
+                    "finished": DEPLOYMENT_FINISHED in stages,
+                    # the stage that took longest is where to look first
+                    "slowest_stage": max(
+                        zip(reached[1:], reached),
+                        key=lambda pair: stages[pair[0]] - stages[pair[1]],
+                        default=(reached[0], None),
+                    )[0],
+                }
+            )
+
+    return {
+        "stages": {stage: _percentiles(s) for stage, s in stage_samples.items()},
+        "total": _percentiles(totals),
+        "unfinished": unfinished,
+        "slo_seconds": slo_seconds,
+        "breaches": sorted(breaches, key=lambda b: -b["seconds"]),
+    }
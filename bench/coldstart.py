@@ -0,0 +1,173 @@
+"""
+Cold start benchmark for the lambda image.
+
+Builds the image once per PULUMI_CLI variant and starts a fresh container
+for every run under the Lambda runtime interface emulator that the base image
+ships with. Each run sends the directory API's "sync" ping, which the handler
+answers without calling Pulumi, so what is measured is the runtime's init
+(imports and module-level setup) and the invoke path around it. Needs docker.
+
+    python bench/coldstart.py                          # slim and full, 5 runs each
+    python bench/coldstart.py --variants slim --runs 20 --warm 10
+    python bench/coldstart.py --no-build --output coldstart.json
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import time
+import urllib.request
+
+from run import ROOT, percentiles, report
+
+DOCKERFILE = os.path.join(ROOT, "lambda", "app", "Dockerfile")
+VARIANTS = ["slim", "full"]
+INVOKE_PATH = "/2015-03-31/functions/function/invocations"
+# what the handler needs to get past import, nothing it would call out with
+ENVIRONMENT = {
+    "PULUMI_ORG": "bench-org",
+    "PULUMI_PROJECT_NAME": "aws-accounts",
+    "PULUMI_ACCESS_TOKEN": "bench",
+    "IDEMPOTENCY_BACKEND": "memory",
+}
+SYNC_EVENT = {"headers": {"X-Goog-Resource-State": "sync"}, "body": "{}"}
+INIT_DURATION = re.compile(r"Init Duration: ([\d.]+) ms")
+
+
+def docker(*args, capture=True):
+    return subprocess.run(
+        ["docker", *args], check=True, capture_output=capture, text=True
+    ).stdout
+
+
+def build(variant, tag):
+    """builds the variant, returns the image size in bytes"""
+    docker(
+        "build",
+        "--file",
+        DOCKERFILE,
+        "--build-arg",
+        f"PULUMI_CLI={variant}",
+        "--tag",
+        tag,
+        ROOT,
+        capture=False,
+    )
+    return image_size(tag)
+
+
+def image_size(tag):
+    return int(docker("image", "inspect", "--format", "{{.Size}}", tag))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def invoke(url, timeout=60):
+    request = urllib.request.Request(
+        url, data=json.dumps(SYNC_EVENT).encode(), method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read() or b"null")
+
+
+def wait_until_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError(f"the emulator didn't listen on {port} within {timeout}s")
+
+
+def cold_start(tag, warm):
+    """
+    Starts a container and invokes it 1 + `warm` times. The emulator only
+    starts the runtime on the first invoke, so its round trip is the cold
+    start as a caller sees it, and the REPORT line has Lambda's own Init
+    Duration for it.
+    """
+    port = free_port()
+    env = [arg for k, v in ENVIRONMENT.items() for arg in ("--env", f"{k}={v}")]
+    started = time.perf_counter()
+    container = docker(
+        "run", "--detach", "--publish", f"127.0.0.1:{port}:8080", *env, tag
+    ).strip()
+    url = f"http://127.0.0.1:{port}{INVOKE_PATH}"
+    try:
+        wait_until_listening(port)
+        listening = time.perf_counter()
+        response = invoke(url)
+        first = time.perf_counter()
+        if not isinstance(response, dict) or response.get("statusCode") != 200:
+            raise RuntimeError(f"unexpected response {response!r}")
+
+        warm_invokes = []
+        for _ in range(warm):
+            invoked = time.perf_counter()
+            invoke(url)
+            warm_invokes.append(time.perf_counter() - invoked)
+
+        logs = docker("logs", container)
+    finally:
+        subprocess.run(["docker", "rm", "--force", container], capture_output=True)
+
+    init = INIT_DURATION.search(logs)
+    return {
+        "container": listening - started,
+        "first_invoke": first - listening,
+        "init": float(init.group(1)) / 1000 if init else None,
+        "warm_invokes": warm_invokes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lambda image cold start benchmark.")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    parser.add_argument("--runs", type=int, default=5, help="Containers per variant")
+    parser.add_argument(
+        "--warm", type=int, default=5, help="Invokes after the first, per container"
+    )
+    parser.add_argument(
+        "--tag", default="gsuite-watcher-bench", help="Image tag prefix"
+    )
+    parser.add_argument(
+        "--no-build", action="store_true", help="Reuse images built by a previous run"
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for variant in args.variants:
+        tag = f"{args.tag}:{variant}"
+        size = image_size(tag) if args.no_build else build(variant, tag)
+        runs = [cold_start(tag, args.warm) for _ in range(args.runs)]
+        label = f"{variant} ({size / 2**20:.0f} MiB)"
+        samples = {
+            "container start": [r["container"] for r in runs],
+            "first invoke": [r["first_invoke"] for r in runs],
+            "init duration": [r["init"] for r in runs if r["init"] is not None],
+            "warm invoke": [s for r in runs for s in r["warm_invokes"]],
+        }
+        for name, values in samples.items():
+            results.append(
+                {
+                    "scenario": f"{label} {name}",
+                    "image_bytes": size,
+                    **percentiles(values),
+                }
+            )
+
+    report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
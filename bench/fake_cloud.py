@@ -0,0 +1,187 @@
+"""
+A local stand-in for the parts of the Pulumi Cloud API this project uses.
+
+It keeps stacks, deployment settings and deployments in memory, can add a
+fixed latency plus jitter to every response and can answer a share of
+requests with a 429, so the retry and pooling behaviour can be measured
+without touching the real service.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+PAGE_SIZE = 100
+
+
+class FakeCloud:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, page_size=PAGE_SIZE):
+        self.latency = latency
+        self.jitter = jitter
+        # share of requests (0-1) answered with a 429
+        self.rate_limit = rate_limit
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.settings = {}
+        self.deployments = {}
+        self.requests = 0
+        self.throttled = 0
+        self._server = None
+
+    def seed(self, org, project, count):
+        with self.lock:
+            for i in range(count):
+                name = f"account-{i:05d}"
+                self.stacks[(org, project, name)] = {
+                    "orgName": org,
+                    "projectName": project,
+                    "stackName": name,
+                    "tags": {"vending:email": f"{name}@example.com"},
+                }
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.settings.clear()
+            self.deployments.clear()
+            self.requests = self.throttled = 0
+
+    def start(self, port=0):
+        cloud = self
+
+        class Handler(RequestHandler):
+            pass
+
+        Handler.cloud = cloud
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, method, path, query, body):
+        """returns (status, payload) for one request"""
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit and random.random() < self.rate_limit:
+                self.throttled += 1
+                return 429, {"code": 429, "message": "rate limited"}
+
+        if method == "GET" and path == "/api/user/stacks":
+            return self.list_stacks(query)
+
+        m = re.fullmatch(r"/api/stacks/([^/]+)/([^/]+)", path)
+        if m and method == "POST":
+            return self.create_stack(m.group(1), m.group(2), body)
+
+        m = re.fullmatch(r"/api/stacks/([^/]+)/([^/]+)/([^/]+)(/.*)?", path)
+        if not m:
+            return 404, {"message": f"no route for {method} {path}"}
+        key, rest = m.group(1, 2, 3), m.group(4) or ""
+        with self.lock:
+            if key not in self.stacks:
+                return 404, {"message": f"stack {'/'.join(key)} not found"}
+
+            if rest == "" and method == "GET":
+                return 200, self.stacks[key]
+            if rest == "/deployments/settings":
+                if method == "GET":
+                    return 200, self.settings.get(key, {})
+                self.settings[key] = body
+                return 200, body
+            if rest == "/deployments" and method == "POST":
+                deployment_id = uuid.uuid4().hex
+                self.deployments[deployment_id] = {
+                    "id": deployment_id,
+                    "status": "accepted",
+                    "created": time.time(),
+                    "operation": body.get("operation"),
+                }
+                return 202, {"id": deployment_id, "consoleUrl": "", "version": 1}
+            m = re.fullmatch(r"/deployments/([^/]+)", rest)
+            if m and method == "GET":
+                deployment = self.deployments.get(m.group(1))
+                if deployment is None:
+                    return 404, {"message": "deployment not found"}
+                # deployments "run" for a second, then succeed
+                age = time.time() - deployment["created"]
+                deployment["status"] = "succeeded" if age > 1 else "running"
+                return 200, deployment
+        return 404, {"message": f"no route for {method} {path}"}
+
+    def list_stacks(self, query):
+        org = query.get("organization")
+        project = query.get("project")
+        start = int(query.get("continuationToken") or 0)
+        with self.lock:
+            stacks = sorted(
+                (
+                    stack
+                    for (o, p, _), stack in self.stacks.items()
+                    if o == org and p == project
+                ),
+                key=lambda stack: stack["stackName"],
+            )
+        page = stacks[start : start + self.page_size]
+        response = {"stacks": page}
+        if start + self.page_size < len(stacks):
+            response["continuationToken"] = str(start + self.page_size)
+        return 200, response
+
+    def create_stack(self, org, project, body):
+        key = (org, project, body["stackName"])
+        with self.lock:
+            if key in self.stacks:
+                return 409, {"code": 409, "message": "stack already exists"}
+            self.stacks[key] = {
+                "orgName": org,
+                "projectName": project,
+                "stackName": body["stackName"],
+                "tags": body.get("tags") or {},
+            }
+        return 200, {}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    cloud = None
+    protocol_version = "HTTP/1.1"
+
+    def _serve(self, method):
+        path, _, raw_query = self.path.partition("?")
+        query = dict(parse_qsl(raw_query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or "{}") if length else {}
+
+        cloud = self.cloud
+        if cloud.latency or cloud.jitter:
+            time.sleep(cloud.latency + random.uniform(0, cloud.jitter))
+
+        status, payload = cloud.handle(method, path, query, body)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
+
+    def do_PATCH(self):
+        self._serve("PATCH")
+
+    def log_message(self, format, *args):
+        pass
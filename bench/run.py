@@ -0,0 +1,311 @@
+"""
+Offline benchmarks for the web app and the lambda.
+
+Runs the real code against a local fake Pulumi Cloud API (fake_cloud.py) and
+a stub pulumi CLI (bin/pulumi) and reports latency percentiles and
+throughput per scenario. Needs the app's and lambda's requirements installed.
+
+    python bench/run.py                      # every scenario
+    python bench/run.py list --stacks 10 100 1000
+    python bench/run.py create --accounts 50 --concurrency 8 --rate-limit 0.05
+    python bench/run.py webhook --events 200 --concurrency 25 --mode cli
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_cloud import FakeCloud
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "bench")
+ORG = "bench-org"
+PROJECT = "aws-accounts"
+SCENARIOS = ["list", "create", "webhook"]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    return {
+        "n": len(samples),
+        "p50_ms": round(at(0.50) * 1000, 2),
+        "p95_ms": round(at(0.95) * 1000, 2),
+        "p99_ms": round(at(0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2),
+    }
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def load_module(name, path, paths):
+    for p in reversed(paths):
+        if p not in sys.path:
+            sys.path.insert(0, p)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stub_cli_env(workdir, latency):
+    """puts the stub pulumi first on PATH, with its own state file"""
+    bin_dir = os.path.join(BENCH_DIR, "bin")
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["STUB_PULUMI_LATENCY"] = str(latency)
+    os.environ["STUB_PULUMI_STATE"] = os.path.join(workdir, "stub-pulumi.json")
+    os.environ["PULUMI_HOME"] = os.path.join(workdir, ".pulumi")
+    os.environ["PULUMI_SKIP_UPDATE_CHECK"] = "true"
+    os.environ["PULUMI_AUTOMATION_API_SKIP_VERSION_CHECK"] = "true"
+    os.environ["PULUMI_ACCESS_TOKEN"] = "bench"
+
+
+def seed_stub_cli(count):
+    with open(os.environ["STUB_PULUMI_STATE"], "w") as f:
+        json.dump([f"account-{i:05d}" for i in range(count)], f)
+
+
+def load_app(url, workdir, args):
+    env = {
+        "FLASK_PULUMI_ACCESS_TOKEN": "bench",
+        "FLASK_PULUMI_ORG": ORG,
+        "FLASK_PULUMI_PROJECT_NAME": PROJECT,
+        "FLASK_PULUMI_API_URL": url,
+        "FLASK_JOBS_DB": os.path.join(workdir, "jobs.db"),
+        "FLASK_STACK_LISTING_BACKEND": "api" if args.mode == "api" else "cli",
+        "FLASK_PROVISIONING_MODE": args.mode,
+        "FLASK_PROVISIONING_WORKERS": str(args.concurrency),
+        "FLASK_INVENTORY_TTL_SECONDS": "3600",
+        "FLASK_DEPLOYMENT_STATUS_INTERVAL_SECONDS": "3600",
+    }
+    os.environ.update(env)
+    app_dir = os.path.join(ROOT, "app")
+    os.chdir(app_dir)
+    return load_module("vending_app", os.path.join(app_dir, "__main__.py"), [app_dir])
+
+
+def load_lambda(url, workdir, args):
+    env = {
+        "PULUMI_ACCESS_TOKEN": "bench",
+        "PULUMI_ORG": ORG,
+        "PULUMI_PROJECT_NAME": PROJECT,
+        "PULUMI_API_URL": url,
+        "PULUMI_WORK_DIR": os.path.join(workdir, "workspace"),
+        "PROVISIONING_MODE": args.mode,
+        "IDEMPOTENCY_BACKEND": "memory",
+    }
+    os.environ.update(env)
+    os.environ.pop("EVENT_QUEUE_URL", None)
+    os.environ.pop("EVENT_QUEUE_PATH", None)
+    return load_module(
+        "lambda_function",
+        os.path.join(ROOT, "lambda", "app", "lambda_function.py"),
+        [os.path.join(ROOT, "lambda", "app"), os.path.join(ROOT, "app")],
+    )
+
+
+def scenario_list(cloud, app, args):
+    """list_accounts at each stack count: a cold listing and cached renders"""
+    results = []
+    client = app.app.test_client()
+    for count in args.stacks:
+        cloud.reset()
+        cloud.seed(ORG, PROJECT, count)
+        if args.mode == "cli":
+            seed_stub_cli(count)
+
+        cold, warm = [], []
+        for _ in range(args.iterations):
+            seconds, _ = timed(app.inventory.refresh)
+            render, response = timed(client.get, "/")
+            assert response.status_code == 200, response.status_code
+            cold.append(seconds + render)
+        for _ in range(args.iterations * 10):
+            seconds, _ = timed(client.get, "/")
+            warm.append(seconds)
+
+        results.append(
+            {"scenario": f"list_accounts cold ({count} stacks)", **percentiles(cold)}
+        )
+        results.append(
+            {"scenario": f"list_accounts cached ({count} stacks)", **percentiles(warm)}
+        )
+    return results
+
+
+def scenario_create(cloud, app, args):
+    """create_account submissions and the end-to-end provisioning they queue"""
+    cloud.reset()
+    prefix = f"bench-{int(time.time())}"
+    local = threading.local()
+
+    def submit(i):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        seconds, response = timed(
+            lambda: local.client.post(
+                "/new",
+                data={
+                    "accountname": f"{prefix}-{i}",
+                    "email": f"{prefix}-{i}@example.com",
+                    "firstname": "Bench",
+                    "lastname": "Mark",
+                },
+                headers={"Accept": "application/json"},
+            )
+        )
+        return seconds, response.get_json()["id"]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        submitted = list(executor.map(submit, range(args.accounts)))
+
+    job_ids = [job_id for _, job_id in submitted]
+    while True:
+        jobs = [app.job_queue.store.get(job_id) for job_id in job_ids]
+        if all(job["status"] in ("succeeded", "failed") for job in jobs):
+            break
+        time.sleep(0.05)
+    wall = time.perf_counter() - started
+
+    failed = [job for job in jobs if job["status"] == "failed"]
+    end_to_end = [job["updated_at"] - job["created_at"] for job in jobs]
+    return [
+        {
+            "scenario": "create_account submit",
+            **percentiles([seconds for seconds, _ in submitted]),
+        },
+        {
+            "scenario": f"create_account end-to-end (x{args.concurrency})",
+            **percentiles(end_to_end),
+            "per_sec": round(len(jobs) / wall, 2),
+            "failed": len(failed),
+            "throttled": cloud.throttled,
+        },
+    ]
+
+
+def scenario_webhook(cloud, lambda_function, args):
+    """a burst of directory notifications against the lambda handler"""
+    cloud.reset()
+    prefix = f"hook-{int(time.time())}"
+    events = []
+    for i in range(args.events):
+        # every fifth notification is a redelivery of the previous one
+        n = i - 1 if i % 5 == 4 else i
+        events.append(
+            {
+                "headers": {
+                    "X-Goog-Resource-Id": "bench-resource",
+                    "X-Goog-Message-Number": str(n),
+                    "X-Goog-Resource-State": "add",
+                },
+                "body": json.dumps({"primaryEmail": f"{prefix}{n}@example.com"}),
+            }
+        )
+
+    def invoke(event):
+        return timed(lambda_function.handler, event, None)[0]
+
+    started = time.perf_counter()
+    # the handler prints every event, keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            latencies = list(executor.map(invoke, events))
+    wall = time.perf_counter() - started
+
+    return [
+        {
+            "scenario": f"webhook burst ({args.events} events, x{args.concurrency})",
+            **percentiles(latencies),
+            "per_sec": round(len(events) / wall, 2),
+            "throttled": cloud.throttled,
+        }
+    ]
+
+
+def report(results, output=None):
+    columns = ["scenario", "n", "p50_ms", "p95_ms", "p99_ms", "max_ms", "per_sec"]
+    widths = [max(len(c), *(len(str(r.get(c, ""))) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        cells = [str(result.get(c, "")) for c in columns]
+        print("  ".join(cell.ljust(w) for cell, w in zip(cells, widths)))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks.")
+    parser.add_argument(
+        "scenarios", nargs="*", help="list, create and/or webhook (default: all)"
+    )
+    parser.add_argument("--mode", choices=["api", "cli"], default="api")
+    parser.add_argument("--stacks", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Fake API latency in seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.02, help="Extra random API latency"
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0.0, help="Share of requests given a 429"
+    )
+    parser.add_argument(
+        "--cli-latency", type=float, default=0.3, help="Stub pulumi start-up cost"
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    scenarios = args.scenarios or SCENARIOS
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="vending-bench-")
+    stub_cli_env(workdir, args.cli_latency)
+    cloud = FakeCloud(
+        latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit
+    )
+    url = cloud.start()
+
+    results = []
+    try:
+        if "list" in scenarios or "create" in scenarios:
+            app = load_app(url, workdir, args)
+            if "list" in scenarios:
+                results += scenario_list(cloud, app, args)
+            if "create" in scenarios:
+                results += scenario_create(cloud, app, args)
+        if "webhook" in scenarios:
+            lambda_function = load_lambda(url, workdir, args)
+            results += scenario_webhook(cloud, lambda_function, args)
+    finally:
+        cloud.stop()
+
+    report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
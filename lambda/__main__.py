@@ -13,8 +13,11 @@ repo = awsx.ecr.Repository(
 image = awsx.ecr.Image(
     "gsuite-watcher",
     dockerfile="app/Dockerfile",
-    path="app",
+    # build from the repo root so the image can include the shared app/ modules
+    path="..",
     repository_url=repo.url,
+    # "slim" ships only the pulumi binaries the function runs, see the Dockerfile
+    args={"PULUMI_CLI": pulumi.Config().get("imageCli") or "slim"},
     env={"DOCKER_BUILDKIT": "1", "DOCKER_DEFAULT_PLATFORM": "linux/amd64"},
 )
 
@@ -46,6 +49,91 @@ aws.iam.RolePolicyAttachment(
     opts=pulumi.ResourceOptions(parent=lambda_role),
 )
 
+# notifications are buffered here and drained in batches by the consumer function
+dead_letter_queue = aws.sqs.Queue(
+    "gsuite-watcher-events-dlq",
+    message_retention_seconds=1209600,
+)
+
+event_queue = aws.sqs.Queue(
+    "gsuite-watcher-events",
+    # must be longer than the consumer's timeout, or batches are redelivered mid-flight
+    visibility_timeout_seconds=360,
+    redrive_policy=dead_letter_queue.arn.apply(
+        lambda arn: json.dumps({"deadLetterTargetArn": arn, "maxReceiveCount": 5})
+    ),
+)
+
+# records which notifications have been handled, see app/idempotency.py
+idempotency_table = aws.dynamodb.Table(
+    "gsuite-watcher-idempotency",
+    billing_mode="PAY_PER_REQUEST",
+    hash_key="key",
+    attributes=[aws.dynamodb.TableAttributeArgs(name="key", type="S")],
+    ttl=aws.dynamodb.TableTtlArgs(attribute_name="expires_at", enabled=True),
+)
+
+aws.iam.RolePolicy(
+    "gsuite-watcher-idempotency",
+    role=lambda_role.id,
+    policy=idempotency_table.arn.apply(
+        lambda arn: json.dumps(
+            {
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Action": ["dynamodb:PutItem", "dynamodb:DeleteItem"],
+                        "Resource": arn,
+                    }
+                ],
+            }
+        )
+    ),
+    opts=pulumi.ResourceOptions(parent=lambda_role),
+)
+
+aws.iam.RolePolicy(
+    "gsuite-watcher-events",
+    role=lambda_role.id,
+    policy=event_queue.arn.apply(
+        lambda arn: json.dumps(
+            {
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Action": [
+                            "sqs:SendMessage",
+                            "sqs:ReceiveMessage",
+                            "sqs:DeleteMessage",
+                            "sqs:GetQueueAttributes",
+                        ],
+                        "Resource": arn,
+                    }
+                ],
+            }
+        )
+    ),
+    opts=pulumi.ResourceOptions(parent=lambda_role),
+)
+
+lambda_environment = {
+    "PULUMI_ACCESS_TOKEN": "changeme",
+    "PULUMI_ORG": "lbrlabs",
+    "PULUMI_PROJECT_NAME": "aws-accounts",
+    "GITHUB_ORG": "lbrlabs",
+    "GITHUB_REPO": "aws-accounts",
+    "AWS_CONTROLTOWER_ORG": "Testing",
+    "AWS_CONTROLTOWER_ORG_ID_ON_DELETE": "ou-p8qa-7ts76j9l",
+    "OIDC_ROLE_ARN": "arn:aws:iam::609316800003:role/pulumi-deploy-ff54f5f",
+    "PULUMI_HOME": "/tmp/.pulumi",
+    "EVENT_QUEUE_URL": event_queue.url,
+    "CONSUMER_CONCURRENCY": "4",
+    "IDEMPOTENCY_BACKEND": "dynamodb",
+    "IDEMPOTENCY_TABLE": idempotency_table.name,
+}
+
 lambda_func = aws.lambda_.Function(
     "gsuite-watcher",
     role=lambda_role.arn,
@@ -53,17 +141,35 @@ lambda_func = aws.lambda_.Function(
     package_type="Image",
     timeout=60,
     environment=aws.lambda_.FunctionEnvironmentArgs(
-        variables={
-            "PULUMI_ACCESS_TOKEN": "changeme",
-            "PULUMI_ORG": "lbrlabs",
-            "PULUMI_PROJECT_NAME": "aws-accounts",
-            "GITHUB_ORG": "lbrlabs",
-            "GITHUB_REPO": "aws-accounts",
-            "AWS_CONTROLTOWER_ORG": "Testing",
-            "AWS_CONTROLTOWER_ORG_ID_ON_DELETE": "ou-p8qa-7ts76j9l",
-            "OIDC_ROLE_ARN": "arn:aws:iam::609316800003:role/pulumi-deploy-ff54f5f",
-            "PULUMI_HOME": "/tmp/.pulumi",
-        }
+        variables=lambda_environment,
+    ),
+)
+
+consumer_func = aws.lambda_.Function(
+    "gsuite-watcher-consumer",
+    role=lambda_role.arn,
+    image_uri=image.image_uri,
+    package_type="Image",
+    image_config=aws.lambda_.FunctionImageConfigArgs(
+        commands=["lambda_function.consumer"],
+    ),
+    timeout=300,
+    environment=aws.lambda_.FunctionEnvironmentArgs(
+        variables=lambda_environment,
+    ),
+)
+
+aws.lambda_.EventSourceMapping(
+    "gsuite-watcher-consumer",
+    event_source_arn=event_queue.arn,
+    function_name=consumer_func.arn,
+    batch_size=25,
+    # wait a little so a burst lands in the same batch and can be coalesced
+    maximum_batching_window_in_seconds=5,
+    function_response_types=["ReportBatchItemFailures"],
+    # caps how many batches hit the Pulumi Cloud API at once
+    scaling_config=aws.lambda_.EventSourceMappingScalingConfigArgs(
+        maximum_concurrency=2,
     ),
 )
 
@@ -0,0 +1,151 @@
+"""
+Buffering for Google Directory push notifications.
+
+A bulk import in Google Workspace sends hundreds of notifications at once. The
+webhook handler only drops them on a queue and acknowledges; a consumer drains
+the queue in batches, collapsing several notifications about the same user
+into one. SQS is used in AWS, and a SQLite file stands in for it locally.
+"""
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+# the push notification headers worth keeping alongside the body
+GOOG_HEADERS = (
+    "x-goog-channel-id",
+    "x-goog-message-number",
+    "x-goog-resource-id",
+    "x-goog-resource-state",
+    "x-goog-resource-uri",
+)
+
+
+def to_message(event):
+    """reduces an API Gateway event to the parts the consumer needs"""
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    return {
+        "headers": {k: headers[k] for k in GOOG_HEADERS if k in headers},
+        "body": event.get("body"),
+        "received_at": time.time(),
+        # follows the event to the stack and its deployment, see timeline.py
+        "correlation_id": uuid.uuid4().hex,
+    }
+
+
+def user_key(message):
+    """identifies the user a notification is about, for coalescing"""
+    try:
+        body = json.loads(message["body"] or "{}")
+    except ValueError:
+        body = {}
+    return body.get("primaryEmail") or body.get("id") or message["headers"].get(
+        "x-goog-resource-id"
+    )
+
+
+def message_number(message):
+    try:
+        return int(message["headers"].get("x-goog-message-number") or 0)
+    except ValueError:
+        return 0
+
+
+def coalesce(messages):
+    """
+    Collapses messages about the same user to the latest one. Takes and returns
+    (receipt, message) pairs, plus the receipts of the messages that were
+    superseded so they can be acknowledged without doing any work.
+    """
+    latest, superseded = {}, []
+    for receipt, message in messages:
+        key = user_key(message)
+        if key is None:
+            key = receipt
+        if key in latest:
+            previous = latest[key]
+            if message_number(message) >= message_number(previous[1]):
+                superseded.append(previous[0])
+                latest[key] = (receipt, message)
+            else:
+                superseded.append(receipt)
+        else:
+            latest[key] = (receipt, message)
+    return list(latest.values()), superseded
+
+
+class SqsQueue:
+    def __init__(self, url: str):
+        self.url = url
+        self._client = None
+
+    @property
+    def client(self):
+        # created on first use, so the consumer's cold start skips boto3
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("sqs")
+        return self._client
+
+    def send(self, message):
+        self.client.send_message(QueueUrl=self.url, MessageBody=json.dumps(message))
+
+
+class SqliteQueue:
+    """a local stand-in for SQS with the same send/receive/delete shape"""
+
+    def __init__(self, path: str, visibility_timeout: int = 300):
+        self.visibility_timeout = visibility_timeout
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                receipt TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                visible_at REAL NOT NULL
+            )
+            """
+        )
+
+    def send(self, message):
+        self.db.execute(
+            "INSERT INTO messages VALUES (?, ?, ?)",
+            (uuid.uuid4().hex, json.dumps(message), time.time()),
+        )
+
+    def receive(self, max_messages: int = 10):
+        """returns up to max_messages (receipt, message) pairs, hiding them for a while"""
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute(
+                "SELECT receipt, body FROM messages WHERE visible_at <= ? "
+                "ORDER BY rowid LIMIT ?",
+                (now, max_messages),
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE messages SET visible_at = ? WHERE receipt = ?",
+                [(now + self.visibility_timeout, receipt) for receipt, _ in rows],
+            )
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return [(receipt, json.loads(body)) for receipt, body in rows]
+
+    def delete(self, receipts):
+        self.db.executemany(
+            "DELETE FROM messages WHERE receipt = ?", [(r,) for r in receipts]
+        )
+
+
+def get_queue():
+    """returns the configured queue, or None to provision inline as before"""
+    if os.getenv("EVENT_QUEUE_URL"):
+        return SqsQueue(os.environ["EVENT_QUEUE_URL"])
+    if os.getenv("EVENT_QUEUE_PATH"):
+        return SqliteQueue(os.environ["EVENT_QUEUE_PATH"])
+    return None
@@ -0,0 +1,166 @@
+"""
+Idempotency records for directory notifications.
+
+Google redelivers push notifications and API Gateway retries on timeouts, so
+the same event can reach us several times. Each event is claimed under a key
+before any provisioning starts; a second claim of the same key is refused
+until the record expires. In-progress claims expire sooner than completed
+ones so an attempt that crashed half way can be retried.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def idempotency_key(message, account_name: str):
+    headers = message.get("headers") or {}
+    resource_id = headers.get("x-goog-resource-id") or "-"
+    message_number = headers.get("x-goog-message-number") or "-"
+    return f"{resource_id}:{message_number}:{account_name}"
+
+
+class MemoryStore:
+    """
+    An LRU of claimed keys. It only lives as long as the container, which is
+    enough to absorb retries that land on the same warm instance.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+
+    def claim(self, key: str, ttl: int):
+        now = time.time()
+        with self._lock:
+            expires_at = self._records.get(key)
+            if expires_at is not None and expires_at > now:
+                self._records.move_to_end(key)
+                return False
+            self._records[key] = now + ttl
+            self._records.move_to_end(key)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+            return True
+
+    def complete(self, key: str, ttl: int):
+        with self._lock:
+            self._records[key] = time.time() + ttl
+
+    def release(self, key: str):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class SqliteStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency "
+            "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+
+    def claim(self, key: str, ttl: int):
+        now = time.time()
+        with self._lock:
+            # only replaces a record that has already expired
+            cursor = self.db.execute(
+                "INSERT INTO idempotency VALUES (?, ?) ON CONFLICT(key) "
+                "DO UPDATE SET expires_at = excluded.expires_at WHERE expires_at <= ?",
+                (key, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, key: str, ttl: int):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO idempotency VALUES (?, ?)",
+                (key, time.time() + ttl),
+            )
+
+    def release(self, key: str):
+        with self._lock:
+            self.db.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+
+class DynamoDbStore:
+    """
+    Records in a DynamoDB table keyed on `key`, with `expires_at` configured as
+    the table's TTL attribute so old records are cleaned up for free.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self._client = None
+
+    @property
+    def client(self):
+        # boto3 is slow to import and the webhook never touches this table, so
+        # only the containers that claim a record pay for it
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("dynamodb")
+        return self._client
+
+    def claim(self, key: str, ttl: int):
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={"key": {"S": key}, "expires_at": {"N": str(now + ttl)}},
+                ConditionExpression="attribute_not_exists(#k) OR expires_at <= :now",
+                ExpressionAttributeNames={"#k": "key"},
+                ExpressionAttributeValues={":now": {"N": str(now)}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def complete(self, key: str, ttl: int):
+        self.client.put_item(
+            TableName=self.table,
+            Item={"key": {"S": key}, "expires_at": {"N": str(int(time.time()) + ttl)}},
+        )
+
+    def release(self, key: str):
+        self.client.delete_item(TableName=self.table, Key={"key": {"S": key}})
+
+
+class Idempotency:
+    def __init__(self, store, ttl: int = 86400, in_progress_ttl: int = 300):
+        self.store = store
+        self.ttl = ttl
+        self.in_progress_ttl = in_progress_ttl
+
+    def claim(self, key: str):
+        """returns False if the key was already claimed and hasn't expired"""
+        return self.store.claim(key, self.in_progress_ttl)
+
+    def complete(self, key: str):
+        self.store.complete(key, self.ttl)
+
+    def release(self, key: str):
+        self.store.release(key)
+
+
+def get_idempotency():
+    backend = os.getenv("IDEMPOTENCY_BACKEND") or "memory"
+    if backend == "dynamodb":
+        store = DynamoDbStore(os.environ["IDEMPOTENCY_TABLE"])
+    elif backend == "sqlite":
+        store = SqliteStore(os.getenv("IDEMPOTENCY_PATH") or "/tmp/idempotency.db")
+    elif backend == "memory":
+        store = MemoryStore()
+    else:
+        raise ValueError(f"unknown IDEMPOTENCY_BACKEND '{backend}'")
+
+    return Idempotency(
+        store,
+        ttl=int(os.getenv("IDEMPOTENCY_TTL") or 86400),
+        in_progress_ttl=int(os.getenv("IDEMPOTENCY_IN_PROGRESS_TTL") or 300),
+    )
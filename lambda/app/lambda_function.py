@@ -1,88 +1,368 @@
-import pulumi
 import requests
+import contextlib
 import os
 import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import deployment_settings
+import dispatch
+import event_queue
+import idempotency
+import metrics
+import timeline
+from pulumi_cloud import PulumiCloudClient, StackAlreadyExistsError
 
-def handler(event, context):
-    
-    print(event)
-    
-    body = json.loads(event["body"])
-    
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE") or "AccountVending"
+
+
+def record_api_request(endpoint, seconds, status):
+    metrics.emf(
+        METRICS_NAMESPACE,
+        {"Endpoint": endpoint, "Status": str(status)},
+        {"PulumiApiLatency": round(seconds * 1000, 2)},
+    )
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """emits the phase's duration, the same phases the web app records"""
+    started = time.monotonic()
+    status = "failed"
     try:
-        email = body["primaryEmail"]
-        name = email.split("@")[0]
-        last_name = name[1:]
-        first_name = name[0]
-        
-        pulumi_org = os.getenv("PULUMI_ORG")
-        pulumi_project_name = os.getenv("PULUMI_PROJECT_NAME")
-        git_org = os.getenv("GITHUB_ORG")
-        git_repo = os.getenv("GITHUB_REPO")
-        git_branch = os.getenv("GITHUB_BRANCH") or "main"
-        aws_controltower_org = os.getenv("AWS_CONTROLTOWER_ORG")
-        aws_controltower_org_id_on_delete = os.getenv("AWS_CONTROLTOWER_ORG_ID_ON_DELETE")
-        oidc_role_arn = os.getenv("OIDC_ROLE_ARN")
-
-        def pulumi_program():
-            return
+        yield
+        status = "succeeded"
+    finally:
+        metrics.emf(
+            METRICS_NAMESPACE,
+            {"Phase": phase, "Status": status},
+            {"PhaseDuration": round((time.monotonic() - started) * 1000, 2)},
+        )
+
+
+# everything below is set up once per container and reused by warm invocations
+pulumi_org = os.getenv("PULUMI_ORG")
+pulumi_project_name = os.getenv("PULUMI_PROJECT_NAME")
+git_org = os.getenv("GITHUB_ORG")
+git_repo = os.getenv("GITHUB_REPO")
+git_branch = os.getenv("GITHUB_BRANCH") or "main"
+aws_controltower_org = os.getenv("AWS_CONTROLTOWER_ORG")
+aws_controltower_org_id_on_delete = os.getenv("AWS_CONTROLTOWER_ORG_ID_ON_DELETE")
+oidc_role_arn = os.getenv("OIDC_ROLE_ARN")
+# AWS_REGION is the lambda's own region, not necessarily the accounts'
+aws_region = os.getenv("DEPLOYMENT_AWS_REGION") or "us-west-2"
+pulumi_home = os.getenv("PULUMI_HOME") or "/tmp/.pulumi"
+work_dir = os.getenv("PULUMI_WORK_DIR") or "/tmp/workspace"
+# "api" registers stacks with one REST call, "cli" through the automation API
+provisioning_mode = os.getenv("PROVISIONING_MODE") or "api"
+
+# an event makes up to three calls (stack, settings, deployment), each given up
+# on after PULUMI_API_CALL_SECONDS, retries included, to fit the 60s timeout
+cloud = PulumiCloudClient(
+    os.getenv("PULUMI_ACCESS_TOKEN"),
+    api_url=os.getenv("PULUMI_API_URL") or "https://api.pulumi.com",
+    timeout=(
+        float(os.getenv("PULUMI_API_CONNECT_TIMEOUT") or 3.05),
+        float(os.getenv("PULUMI_API_READ_TIMEOUT") or 10),
+    ),
+    max_retries=int(os.getenv("PULUMI_API_MAX_RETRIES") or 2),
+    max_backoff=4.0,
+    max_elapsed=float(os.getenv("PULUMI_API_CALL_SECONDS") or 12),
+    on_request=record_api_request,
+)
+
+
+def fetch_deployment_status(org, project, stack, deployment_id):
+    r = cloud.get_deployment(org, project, stack, deployment_id)
+    r.raise_for_status()
+    return r.json()["status"]
+
+
+# paces the deployments this container dispatches, deletes first
+deployment_dispatcher = dispatch.DeploymentScheduler(
+    cloud.create_deployment,
+    fetch_deployment_status,
+    rate=float(os.getenv("DEPLOYMENT_RATE_PER_SECOND") or 1),
+    burst=int(os.getenv("DEPLOYMENT_BURST") or 5),
+    max_running=int(os.getenv("DEPLOYMENT_MAX_RUNNING") or 10),
+    poll_interval=float(os.getenv("DEPLOYMENT_RUNNING_POLL_SECONDS") or 5),
+)
+# a queued deployment is given up on after this long so the event fails and is
+# redelivered, instead of the function running into its own timeout while the
+# org is at DEPLOYMENT_MAX_RUNNING
+dispatch_timeout = float(os.getenv("DEPLOYMENT_DISPATCH_TIMEOUT_SECONDS") or 15)
+# with a queue configured the webhook only buffers events for the consumer
+queue = event_queue.get_queue()
+consumer_concurrency = int(os.getenv("CONSUMER_CONCURRENCY") or 4)
+# stage timestamps for `latency-report`, on stdout and optionally in a file
+timelines = timeline.Timeline(os.getenv("TIMELINE_PATH"))
+# claims each notification so redeliveries and retries are skipped
+seen = idempotency.get_idempotency()
+
+
+def pulumi_program():
+    return
+
 
-        stack = pulumi.automation.create_stack(
-            f"{pulumi_org}/{pulumi_project_name}/{name}",
-            project_name=pulumi_project_name,
+def prepare_pulumi_home():
+    # /tmp survives between warm invocations, so only the first one pays for this.
+    # The image can ship a pre-populated PULUMI_HOME (plugins etc.) to copy from.
+    seed = os.getenv("PULUMI_HOME_SEED")
+    if seed and os.path.isdir(seed) and not os.path.isdir(pulumi_home):
+        shutil.copytree(seed, pulumi_home)
+    os.makedirs(pulumi_home, exist_ok=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+
+_workspace = None
+
+
+def get_workspace():
+    """returns the container's LocalWorkspace, creating it on first use"""
+    global _workspace
+    if _workspace is None:
+        # pulumi is slow to import, so only the CLI path pays for it
+        import pulumi.automation
+
+        prepare_pulumi_home()
+        _workspace = pulumi.automation.LocalWorkspace(
+            work_dir=work_dir,
+            pulumi_home=pulumi_home,
             program=pulumi_program,
-            work_dir="/tmp",
+            project_settings=pulumi.automation.ProjectSettings(
+                name=pulumi_project_name, runtime="python"
+            ),
         )
+    return _workspace
+
+
+# the same tags the web app puts on the stacks it creates
+EMAIL_TAG = "vending:email"
+OU_TAG = "vending:ou"
+
+
+def create_stack(name, email, correlation_id=None):
+    tags = {
+        EMAIL_TAG: email,
+        OU_TAG: aws_controltower_org,
+        timeline.CORRELATION_TAG: correlation_id,
+    }
+    # the CLI refuses empty tag values
+    tags = {key: value for key, value in tags.items() if value}
+    if provisioning_mode == "api":
+        try:
+            with timed_phase("create_stack"):
+                cloud.create_stack(pulumi_org, pulumi_project_name, name, tags=tags)
+            return
+        except requests.exceptions.RequestException as err:
+            print(f"Error creating stack '{name}' through the API: {err}")
+            print("Falling back to the automation API")
+
+    import pulumi.automation
+
+    try:
+        with timed_phase("create_stack"):
+            stack = pulumi.automation.Stack.create(
+                f"{pulumi_org}/{pulumi_project_name}/{name}", get_workspace()
+            )
+    except pulumi.automation.StackAlreadyExistsError as err:
+        raise StackAlreadyExistsError(str(err))
+
+    with timed_phase("set_config"):
         stack.set_config("name", pulumi.automation.ConfigValue(value=name))
         stack.set_config("email", pulumi.automation.ConfigValue(value=email))
+        for key, value in tags.items():
+            stack.workspace.set_tag(stack.name, key, value)
 
+    with timed_phase("refresh"):
         stack.refresh()
-        access_token = os.getenv("PULUMI_ACCESS_TOKEN")
-
-        headers = {"Authorization": f"token {access_token}"}
-
-        r = requests.post(
-            f"https://api.pulumi.com/api/stacks/{pulumi_org}/{pulumi_project_name}/{name}/deployments/settings",
-            json={
-                "sourceContext": {"git": {"branch": f"refs/heads/{git_branch}"}},
-                "gitHub": {
-                    "repository": f"{git_org}/{git_repo}",
-                    "deployCommits": True,
-                    "previewPullRequests": True,
-                },
-                "operationContext": {
-                    "preRunCommands": [
-                        f"pulumi config set name {name} -s {pulumi_org}/{name}",
-                        f"pulumi config set email {email} -s {pulumi_org}/{name}",
-                        f"pulumi config set organizationalUnit {aws_controltower_org} -s {pulumi_org}/{name}",
-                        f"pulumi config set organizationalUnitIdOnDelete {aws_controltower_org_id_on_delete} -s {pulumi_org}/{name}",
-                        f"pulumi config set ssoEmail {email} -s {pulumi_org}/{name}",
-                        f"pulumi config set ssoFirstName {first_name} -s {pulumi_org}/{name}",
-                        f"pulumi config set ssoLastName {last_name} -s {pulumi_org}/{name}",
-                        
-                    ],
-                    "oidc": {
-                        "aws": {
-                            "roleArn": oidc_role_arn,
-                            "sessionName": "deployment",
-                        }
-                    },
-                    "environmentVariables": {"AWS_REGION": "us-west-2"},
-                },
-            },
-            headers=headers,
+
+
+def provision(email, correlation_id=None):
+    name = email.split("@")[0]
+    last_name = name[1:]
+    first_name = name[0]
+    timelines.record(correlation_id, timeline.STARTED, stack=name)
+
+    try:
+        create_stack(name, email, correlation_id)
+    except StackAlreadyExistsError:
+        # an earlier attempt at this event may have failed after creating it
+        print(f"Stack '{name}' already exists, updating its deployment settings")
+    timelines.record(correlation_id, timeline.STACK_CREATED, stack=name)
+
+    with timed_phase("deployment_settings"):
+        r = cloud.update_deployment_settings(
+            pulumi_org,
+            pulumi_project_name,
+            name,
+            deployment_settings.deployment_settings(
+                pulumi_org=pulumi_org,
+                name=name,
+                email=email,
+                first_name=first_name,
+                last_name=last_name,
+                ou=aws_controltower_org,
+                ou_id_on_delete=aws_controltower_org_id_on_delete,
+                git_org=git_org,
+                git_repo=git_repo,
+                git_branch=git_branch,
+                oidc_role_arn=oidc_role_arn,
+                aws_region=aws_region,
+                correlation_id=correlation_id,
+            ),
         )
+        print(f"Status Code: {r.status_code}, Response: {r.text}")
+        # fails the event, so its key is released and the message redelivered
+        r.raise_for_status()
+    timelines.record(correlation_id, timeline.SETTINGS_WRITTEN, stack=name)
+
+    with timed_phase("deployment"):
+        r = deployment_dispatcher.dispatch(
+            pulumi_org, pulumi_project_name, name, "update", timeout=dispatch_timeout
+        )
+        print(f"Status Code: {r.status_code}, Response: {r.text}")
+        r.raise_for_status()
+    timelines.record(
+        correlation_id,
+        timeline.DEPLOYMENT_DISPATCHED,
+        stack=name,
+        deployment_id=r.json()["id"],
+    )
 
-        print(f"Status Code: {r.status_code}, Response: {r.json()}")
 
-        r = requests.post(
-            f"https://api.pulumi.com/api/stacks/{pulumi_org}/{pulumi_project_name}/{name}/deployments",
-            json={
-                "operation": "update",
-            },
-            headers=headers,
+def offboard(email, correlation_id=None):
+    """dispatches the delete deployment for a user removed from the directory"""
+    name = email.split("@")[0]
+    with timed_phase("delete_deployment"):
+        r = deployment_dispatcher.dispatch(
+            pulumi_org, pulumi_project_name, name, "delete", timeout=dispatch_timeout
         )
-        print(f"Status Code: {r.status_code}, Response: {r.json()}")
+    timelines.record(correlation_id, timeline.NOT_PROVISIONED, stack=name)
+    if r.status_code == 404:
+        print(f"No stack for '{name}', nothing to delete")
+        return
+    r.raise_for_status()
+    print(f"Status Code: {r.status_code}, Response: {r.json()}")
+
+
+def reconcile(email, correlation_id=None):
+    """provisions an updated user only if they don't have an account yet"""
+    name = email.split("@")[0]
+    r = cloud.get_stack(pulumi_org, pulumi_project_name, name)
+    if r.status_code != 404:
+        r.raise_for_status()
+        print(f"Stack '{name}' exists, nothing to do")
+        timelines.record(correlation_id, timeline.NOT_PROVISIONED, stack=name)
+        return
+    provision(email, correlation_id)
+
+
+# X-Goog-Resource-State to the handler for it; anything else (the "sync" ping
+# sent when a channel opens) is acknowledged without doing any work
+ROUTES = {"add": provision, "update": reconcile, "delete": offboard}
+
+
+def resource_state(message):
+    # events without the header (e.g. invoked by hand) are treated as adds
+    return message["headers"].get("x-goog-resource-state") or "add"
+
+
+def process(message):
+    """handles one buffered (or inline) notification"""
+    route = ROUTES.get(resource_state(message))
+    if route is None:
+        return
+
+    body = json.loads(message["body"] or "{}")
+
+    correlation_id = message.get("correlation_id")
+    try:
+        email = body["primaryEmail"]
     except KeyError:
         print("no body")
+        timelines.record(correlation_id, timeline.NOT_PROVISIONED)
+        return
+
+    key = idempotency.idempotency_key(message, email.split("@")[0])
+    if not seen.claim(key):
+        print(f"Skipping duplicate event {key}")
+        timelines.record(correlation_id, timeline.NOT_PROVISIONED)
+        return
+
+    try:
+        route(email, correlation_id)
+    except Exception:
+        seen.release(key)
+        raise
+    seen.complete(key)
+
+
+def handler(event, context):
+
+    print(event)
+
+    message = event_queue.to_message(event)
+    state = resource_state(message)
+    if state not in ROUTES:
+        print(f"Ignoring '{state}' notification")
+        return {"statusCode": 200}
+
+    timelines.record(
+        message["correlation_id"], timeline.RECEIVED, at=message["received_at"]
+    )
+    if queue is None:
+        process(message)
+        return {"statusCode": 200}
+
+    queue.send(message)
+    return {"statusCode": 202}
+
+
+def process_batch(messages):
+    """
+    Coalesces a batch of (receipt, message) pairs per user and provisions them
+    at most consumer_concurrency at a time. Returns the receipts that failed.
+    """
+    latest, superseded = event_queue.coalesce(messages)
+    print(f"Processing {len(latest)} events, {len(superseded)} superseded")
+    by_receipt = dict(messages)
+    for receipt in superseded:
+        timelines.record(
+            by_receipt[receipt].get("correlation_id"), timeline.NOT_PROVISIONED
+        )
+
+    def run(pair):
+        receipt, message = pair
+        try:
+            process(message)
+        except Exception as exn:
+            print(f"Error processing event {receipt}: {exn}")
+            return receipt
+
+    with ThreadPoolExecutor(max_workers=consumer_concurrency) as executor:
+        return [receipt for receipt in executor.map(run, latest) if receipt]
+
+
+def consumer(event, context):
+    """drains the SQS event buffer, reporting failed messages back for a retry"""
+    messages = [
+        (record["messageId"], json.loads(record["body"])) for record in event["Records"]
+    ]
+    failed = process_batch(messages)
+    return {"batchItemFailures": [{"itemIdentifier": r} for r in failed]}
+
+
+def drain(batch_size=10):
+    """drains a local SQLite event buffer until it is empty"""
+    while True:
+        messages = queue.receive(batch_size)
+        if not messages:
+            return
+        failed = set(process_batch(messages))
+        queue.delete([receipt for receipt, _ in messages if receipt not in failed])
+
+
+if __name__ == "__main__":
+    drain()
@@ -1,10 +1,14 @@
 import argparse
+import os
 import google.auth
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+import daemon
+import sync
+
 # Setup the Admin SDK API
 SCOPES = ["https://www.googleapis.com/auth/admin.directory.user.readonly"]
 
@@ -74,8 +78,88 @@ def stop_channel(channel_id, resource_id):
         print(f"Error stopping channel: {e}")
 
 
+def sync_options(args):
+    return {
+        "pulumi_org": args.pulumi_org,
+        "pulumi_project": args.pulumi_project,
+        "access_token": os.getenv("PULUMI_ACCESS_TOKEN"),
+        "api_url": os.getenv("PULUMI_API_URL") or "https://api.pulumi.com",
+        "checkpoint_path": args.checkpoint,
+        "resend_after": args.resend_after,
+        "remove": args.remove,
+        "max_removes": args.max_removes,
+        "batch_size": args.batch_size,
+        "dry_run": args.dry_run,
+    }
+
+
+def sync_users(args):
+    credentials = get_credentials()
+    service = build("admin", "directory_v1", credentials=credentials)
+
+    try:
+        sync.sync(service, args.domain, args.address, **sync_options(args))
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+
+
+def run_daemon(args):
+    watcher = daemon.Watcher(
+        get_credentials(),
+        discovery_path=args.discovery_cache,
+        channels_path=args.channels,
+    )
+    watcher.run(
+        args.domain,
+        args.address,
+        interval=args.interval,
+        renew_before=args.renew_before,
+        sync_every=args.sync_every,
+        sync_options=sync_options(args),
+    )
+
+
+def add_sync_arguments(parser, required=True):
+    parser.add_argument(
+        "--pulumi-org",
+        required=required,
+        help="The Pulumi organization of the stacks",
+    )
+    parser.add_argument(
+        "--pulumi-project",
+        required=required,
+        help="The Pulumi project of the stacks",
+    )
+    parser.add_argument(
+        "--checkpoint", default="sync.json", help="Where to remember what was sent"
+    )
+    parser.add_argument(
+        "--resend-after",
+        type=int,
+        default=3600,
+        help="Seconds before a user that is still missing is sent again",
+    )
+    parser.add_argument(
+        "--remove",
+        action="store_true",
+        help="Also send delete notifications for stacks without a user",
+    )
+    parser.add_argument(
+        "--max-removes",
+        type=int,
+        default=20,
+        help="Skip removals when more stacks than this would be removed",
+    )
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only print the differences"
+    )
+
+
 def main():
-    parser = argparse.ArgumentParser(description="Script with start and stop commands.")
+    parser = argparse.ArgumentParser(
+        description="Script with start, stop, sync and daemon commands."
+    )
 
     subparsers = parser.add_subparsers(title="commands", dest="command")
 
@@ -99,14 +183,72 @@ def main():
         "--resource-id", required=True, help="The resource id to stop"
     )
 
+    sync_parser = subparsers.add_parser(
+        "sync", help="send the webhook any users missing from the stacks"
+    )
+    sync_parser.add_argument(
+        "--domain", required=True, help="Domain name to operate on"
+    )
+    sync_parser.add_argument(
+        "--address", required=True, help="The webhook address to send notifications to"
+    )
+    add_sync_arguments(sync_parser)
+
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="keep a channel open, renewing it before it expires"
+    )
+    daemon_parser.add_argument(
+        "--domain", required=True, help="Domain name to operate on"
+    )
+    daemon_parser.add_argument(
+        "--address", required=True, help="The webhook address to send notifications to"
+    )
+    daemon_parser.add_argument(
+        "--interval", type=int, default=300, help="Seconds between checks"
+    )
+    daemon_parser.add_argument(
+        "--renew-before",
+        type=int,
+        default=3600,
+        help="Renew channels expiring within this many seconds",
+    )
+    daemon_parser.add_argument(
+        "--sync-every",
+        type=int,
+        default=0,
+        help="Also run sync every this many seconds",
+    )
+    daemon_parser.add_argument(
+        "--channels", default="channels.json", help="Where to keep the open channels"
+    )
+    daemon_parser.add_argument(
+        "--discovery-cache",
+        default="directory_v1.json",
+        help="Where to cache the Directory API discovery document",
+    )
+    add_sync_arguments(daemon_parser, required=False)
+
     args = parser.parse_args()
 
     if args.command == "start":
         watch_users(args.domain, args.channel_id, args.address)
     elif args.command == "stop":
         stop_channel(args.channel_id, args.resource_id)
+    elif args.command == "sync":
+        if not os.getenv("PULUMI_ACCESS_TOKEN"):
+            parser.error("sync needs PULUMI_ACCESS_TOKEN")
+        sync_users(args)
+    elif args.command == "daemon":
+        if args.sync_every and not (
+            args.pulumi_org and args.pulumi_project and os.getenv("PULUMI_ACCESS_TOKEN")
+        ):
+            parser.error(
+                "--sync-every needs --pulumi-org, --pulumi-project "
+                "and PULUMI_ACCESS_TOKEN"
+            )
+        run_daemon(args)
     else:
-        print("Please provide a valid command (start or stop).")
+        print("Please provide a valid command (start, stop, sync or daemon).")
         parser.print_help()
 
 
@@ -0,0 +1,151 @@
+"""
+A long-running watcher.
+
+The one-shot commands read token.json and build the Directory client on
+every run, and the channels they start quietly expire after a few hours.
+The daemon builds the client once from a discovery document cached on disk,
+refreshes the access token in memory when it runs out, and replaces each
+channel with a new one shortly before it expires.
+"""
+
+import json
+import os
+import time
+import uuid
+
+import requests
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build_from_document
+
+import sync
+
+DISCOVERY_URL = "https://admin.googleapis.com/$discovery/rest?version=directory_v1"
+
+
+def load_discovery_document(path: str):
+    """returns the Directory API discovery document, downloading it only once"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    r = requests.get(DISCOVERY_URL, timeout=30)
+    r.raise_for_status()
+    with open(path, "w") as f:
+        f.write(r.text)
+    return r.text
+
+
+class Watcher:
+    def __init__(
+        self,
+        credentials,
+        discovery_path="directory_v1.json",
+        channels_path="channels.json",
+        token_path="token.json",
+    ):
+        self.credentials = credentials
+        self.token_path = token_path
+        self.channels_path = channels_path
+        self.service = build_from_document(
+            load_discovery_document(discovery_path), credentials=credentials
+        )
+        self.channels = self._load_channels()
+
+    def ensure_fresh_credentials(self):
+        """refreshes the access token in memory, before it is used expired"""
+        if self.credentials.valid:
+            return
+        self.credentials.refresh(Request())
+        # let the one-shot commands pick up the new token too
+        with open(self.token_path, "w") as token:
+            token.write(self.credentials.to_json())
+
+    def watch(self, domain: str, address: str, prefix: str = "vending"):
+        self.ensure_fresh_credentials()
+        channel_id = f"{prefix}-{uuid.uuid4().hex}"
+        result = (
+            self.service.users()
+            .watch(
+                domain=domain,
+                body={"id": channel_id, "type": "web_hook", "address": address},
+            )
+            .execute()
+        )
+        channel = {
+            "id": result["id"],
+            "resourceId": result["resourceId"],
+            "domain": domain,
+            "address": address,
+            # milliseconds since the epoch, as the API returns it
+            "expiration": int(result.get("expiration") or 0),
+        }
+        self.channels.append(channel)
+        self._save_channels()
+        print(f"Channel {channel['id']} created, expires {channel['expiration']}")
+        return channel
+
+    def stop(self, channel):
+        try:
+            self.ensure_fresh_credentials()
+            self.service.channels().stop(
+                body={"id": channel["id"], "resourceId": channel["resourceId"]}
+            ).execute()
+            print(f"Channel {channel['id']} stopped")
+        except Exception as error:
+            # it may have expired already, which is just as good; if not, it
+            # expires on its own, and keeping it would get it renewed again
+            print(f"Error stopping channel {channel['id']}: {error}")
+        self.channels = [c for c in self.channels if c["id"] != channel["id"]]
+        self._save_channels()
+
+    def renew(self, renew_before: int):
+        """replaces every channel that expires within renew_before seconds"""
+        deadline = (time.time() + renew_before) * 1000
+        for channel in list(self.channels):
+            if channel["expiration"] and channel["expiration"] > deadline:
+                continue
+            # start the new channel first so no notification falls in a gap
+            self.watch(channel["domain"], channel["address"])
+            self.stop(channel)
+
+    def run(
+        self,
+        domain: str,
+        address: str,
+        *,
+        interval: int = 300,
+        renew_before: int = 3600,
+        sync_every: int = 0,
+        sync_options: dict = None,
+    ):
+        last_sync = 0
+        while True:
+            # anything can fail for a while (token refresh, network, the API);
+            # giving up would let the channel expire, so try again next round
+            try:
+                if not any(
+                    c["domain"] == domain and c["address"] == address
+                    for c in self.channels
+                ):
+                    self.watch(domain, address)
+                self.renew(renew_before)
+                if sync_every and time.time() - last_sync >= sync_every:
+                    self.ensure_fresh_credentials()
+                    sync.sync(self.service, domain, address, **sync_options)
+                    last_sync = time.time()
+            except Exception as error:
+                print(f"An error occurred: {error}", flush=True)
+            time.sleep(interval)
+
+    def _load_channels(self):
+        if not os.path.exists(self.channels_path):
+            return []
+        with open(self.channels_path) as f:
+            return json.load(f)
+
+    def _save_channels(self):
+        tmp = f"{self.channels_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.channels, f, indent=2)
+        os.replace(tmp, self.channels_path)
@@ -0,0 +1,189 @@
+"""
+Reconciles the directory with the account stacks.
+
+Push notifications can be missed or arrive after a channel expired, leaving
+users without an account (or accounts without a user). `sync` lists the
+domain's active users with a minimal fields mask, lists the account stacks
+from Pulumi Cloud, and sends the webhook only the differences, shaped like
+the notifications Google would have sent. A checkpoint file remembers what
+was already sent so the next run doesn't resend it while it is still being
+provisioned.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# only the fields the diff needs, which keeps each 500-user page small
+USER_FIELDS = "nextPageToken,users(primaryEmail)"
+PAGE_SIZE = 500
+
+
+def list_active_users(service, domain: str):
+    """yields the primary email of every active user in the domain"""
+    users = service.users()
+    request = users.list(
+        domain=domain,
+        maxResults=PAGE_SIZE,
+        projection="basic",
+        query="isSuspended=false",
+        fields=USER_FIELDS,
+    )
+    while request is not None:
+        response = request.execute()
+        for user in response.get("users", []):
+            yield user["primaryEmail"]
+        request = users.list_next(request, response)
+
+
+def list_stack_names(org: str, project: str, access_token: str, api_url: str):
+    """returns the names of the project's stacks in Pulumi Cloud"""
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Accept": "application/vnd.pulumi+8",
+            "Authorization": f"token {access_token}",
+        }
+    )
+    names, token = set(), None
+    while True:
+        params = {"organization": org, "project": project}
+        if token:
+            params["continuationToken"] = token
+        r = session.get(f"{api_url}/api/user/stacks", params=params, timeout=20)
+        r.raise_for_status()
+        body = r.json()
+        names.update(stack["stackName"] for stack in body.get("stacks") or [])
+        token = body.get("continuationToken")
+        if not token:
+            return names
+
+
+def account_name(email: str):
+    # the same mapping the lambda uses when it provisions an account
+    return email.split("@")[0]
+
+
+def diff(emails, stack_names):
+    """returns (emails to add, stack names to remove)"""
+    by_name = {account_name(email): email for email in emails}
+    adds = sorted(email for name, email in by_name.items() if name not in stack_names)
+    removes = sorted(name for name in stack_names if name not in by_name)
+    return adds, removes
+
+
+def load_checkpoint(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"synced_at": None, "sent": {}}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def notification(state: str, email: str, run_id: str, number: int):
+    """a request shaped like a Directory push notification"""
+    return {
+        "headers": {
+            "X-Goog-Channel-Id": "sync",
+            "X-Goog-Resource-Id": f"sync-{run_id}",
+            "X-Goog-Message-Number": str(number),
+            "X-Goog-Resource-State": state,
+        },
+        "json": {"primaryEmail": email},
+    }
+
+
+def emit(address: str, notifications, batch_size: int = 25):
+    """
+    Posts the notifications to the webhook batch_size at a time and returns
+    the ones that were accepted.
+    """
+    session = requests.Session()
+
+    def post(n):
+        try:
+            r = session.post(address, timeout=30, **n)
+            r.raise_for_status()
+            return n
+        except requests.exceptions.RequestException as err:
+            print(f"Error sending {n['json']['primaryEmail']}: {err}")
+
+    sent = []
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        for start in range(0, len(notifications), batch_size):
+            batch = notifications[start : start + batch_size]
+            sent += [n for n in executor.map(post, batch) if n]
+            print(f"Sent {len(sent)} of {len(notifications)} notifications")
+    return sent
+
+
+def sync(
+    service,
+    domain: str,
+    address: str,
+    *,
+    pulumi_org: str,
+    pulumi_project: str,
+    access_token: str,
+    api_url: str = "https://api.pulumi.com",
+    checkpoint_path: str = "sync.json",
+    resend_after: int = 3600,
+    remove: bool = False,
+    max_removes: int = 20,
+    batch_size: int = 25,
+    dry_run: bool = False,
+):
+    started = time.time()
+    checkpoint = load_checkpoint(checkpoint_path)
+    # drop the sends that are old enough to try again
+    sent = {
+        key: sent_at
+        for key, sent_at in checkpoint["sent"].items()
+        if started - sent_at < resend_after
+    }
+
+    emails = list(list_active_users(service, domain))
+    stack_names = list_stack_names(pulumi_org, pulumi_project, access_token, api_url)
+    adds, removes = diff(emails, stack_names)
+    print(
+        f"{len(emails)} users, {len(stack_names)} stacks: "
+        f"{len(adds)} to add, {len(removes)} to remove"
+    )
+
+    if removes and not remove:
+        print(f"Not removing {len(removes)} stacks without --remove")
+        removes = []
+    elif len(removes) > max_removes:
+        # an empty or partial listing must never offboard everyone
+        print(f"Not removing {len(removes)} stacks, more than --max-removes")
+        removes = []
+
+    run_id = str(int(started))
+    pending = [("add", email) for email in adds] + [
+        ("delete", f"{name}@{domain}") for name in removes
+    ]
+    pending = [(state, email) for state, email in pending if email not in sent]
+    notifications = [
+        notification(state, email, run_id, number)
+        for number, (state, email) in enumerate(pending, start=1)
+    ]
+
+    if dry_run:
+        for state, email in pending:
+            print(f"{state} {email}")
+        return
+
+    for n in emit(address, notifications, batch_size):
+        sent[n["json"]["primaryEmail"]] = started
+    save_checkpoint(checkpoint_path, {"synced_at": started, "sent": sent})
+    print(f"Sync finished in {time.time() - started:.1f}s")